@@ -0,0 +1,67 @@
+"""compare the vectorized estimate_advantages with the previous per-step loop, run from src: python -m benchmarks.gae"""
+import time
+import torch
+from core.common import estimate_advantages
+from utils.torch import to_device
+
+
+def estimate_advantages_loop(rewards, masks, bad_masks, values, next_values, gamma, tau, device):
+    rewards, masks, bad_masks, values, next_values = to_device(torch.device('cpu'),
+                                                               rewards, masks, bad_masks,
+                                                               values, next_values)
+    tensor_type = type(rewards)
+    deltas = tensor_type(rewards.size(0), 1)
+    advantages = tensor_type(rewards.size(0), 1)
+
+    prev_advantage = 0
+    for i in reversed(range(rewards.size(0))):
+        deltas[i] = rewards[i] + gamma * next_values[i] - values[i]
+        advantages[i] = deltas[i] + gamma * tau * prev_advantage * masks[i]
+        advantages[i] = advantages[i] * bad_masks[i]
+        prev_advantage = advantages[i, 0]
+
+    returns = values + advantages
+    advantages = (advantages - advantages.mean()) / advantages.std()
+
+    advantages, returns = to_device(device, advantages, returns)
+    return advantages, returns
+
+
+def make_batch(n_steps, device, max_len=50):
+    """consecutive episodes of random length, with the mask layout produced by core.agent"""
+    lengths = torch.randint(1, max_len + 1, (n_steps // 2 + 1,))
+    lengths = lengths[:int((lengths.cumsum(0) < n_steps).sum()) + 1]
+    lengths[-1] -= lengths.sum() - n_steps
+    step = torch.cat([torch.arange(int(n)) for n in lengths if n > 0])
+    last = torch.cat([torch.arange(int(n)) == n - 1 for n in lengths if n > 0])
+    masks = (~last).long()
+    bad_masks = (~(last & ((torch.rand(n_steps) < 0.3) | (step == max_len - 1)))).long()
+    rewards = torch.randn(n_steps)
+    values, next_values = torch.randn(n_steps, 1), torch.randn(n_steps, 1)
+    return to_device(device, rewards, masks, bad_masks, values, next_values)
+
+
+def bench(fn, batch, device, repeat):
+    fn(*batch, 0.99, 0.95, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn(*batch, 0.99, 0.95, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, out
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+    for n_steps in [8192, 65536, 524288]:
+        batch = make_batch(n_steps, torch.device('cpu'))
+        loop_time, (loop_adv, loop_ret) = bench(estimate_advantages_loop, batch, torch.device('cpu'), 1)
+        print('steps %d | loop cpu %.4fs' % (n_steps, loop_time))
+        for device in devices:
+            scan_time, (adv, ret) = bench(estimate_advantages, to_device(device, *batch), device, 10)
+            err = max((adv.cpu() - loop_adv).abs().max().item(), (ret.cpu() - loop_ret).abs().max().item())
+            print('steps %d | scan %s %.4fs | speedup %.1fx | max abs diff %.2e'
+                  % (n_steps, device.type, scan_time, loop_time / scan_time, err))
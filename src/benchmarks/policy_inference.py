@@ -0,0 +1,44 @@
+"""compare the scripted PolicyInference with the eager PolicyCNN on CPU, run from src: python -m benchmarks.policy_inference"""
+import time
+import numpy as np
+import torch
+from network_env import RoadWorld
+from model.policy import PolicyCNN, script_policy
+
+
+def make_policy(env, n_time_steps=200, n_path_feature=13, n_edge_feature=9):
+    """PolicyCNN of the road network with random feature tables of the training shapes"""
+    n_link = env.n_states - 1
+    path_feature = np.random.rand(n_link, n_link, n_path_feature).astype(np.float32)
+    edge_feature = np.zeros((env.n_states, n_edge_feature))
+    edge_feature[:n_link] = np.random.rand(n_link, n_edge_feature)
+    speed_feature = np.random.rand(env.n_states, n_time_steps + 1).astype(np.float32)
+    return PolicyCNN(env.n_actions, env.policy_mask, env.state_action, path_feature, edge_feature,
+                     n_path_feature + n_edge_feature + 1, env.pad_idx, speed_feature)
+
+
+def bench(fn, batch, repeat):
+    with torch.no_grad():
+        fn(*batch)
+        start = time.time()
+        for _ in range(repeat):
+            out = fn(*batch)
+    return (time.time() - start) / repeat, out
+
+
+if __name__ == '__main__':
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = RoadWorld('../data/base/transit.npy', '../data/base/edge.txt')
+    policy = make_policy(env)
+    scripted = script_policy(policy)
+    for batch_size, repeat in [(1, 2000), (64, 1000), (8192, 20)]:
+        state = torch.randint(0, env.n_states - 1, (batch_size,))
+        des = torch.randint(0, env.n_states - 1, (batch_size,))
+        time_step = torch.randint(0, 200, (batch_size,))
+        batch = (state, des, time_step)
+        eager_time, eager_prob = bench(policy.get_action_prob, batch, repeat)
+        script_time, script_prob = bench(scripted.get_action_prob, batch, repeat)
+        err = (eager_prob - script_prob).abs().max().item()
+        print('batch %d | eager %.1fus | scripted %.1fus | speedup %.2fx | max abs diff %.2e'
+              % (batch_size, eager_time * 1e6, script_time * 1e6, eager_time / script_time, err))
@@ -1,14 +1,23 @@
-import multiprocessing
+import copy
 import math
 import time
 import os
+import queue
 import torch
+import torch.multiprocessing as multiprocessing
 import numpy as np
-from utils.replay_memory import Memory
+from utils.replay_memory import Memory, concat_samples
+from network_env import BatchedRoadWorld
 from utils.torch import to_device
+from utils.policy_cache import PolicyTableCache
+from model.policy import script_policy
 
 os.environ["OMP_NUM_THREADS"] = "1"
 
+# worker processes are spawned, not forked: the trainer may already hold CUDA state, and spawn is the default on
+# macOS / Windows anyway; everything handed to a worker is a picklable CPU object (eager modules, shared tensors)
+mp_context = multiprocessing.get_context('spawn')
+
 
 def collect_samples(pid, queue, env, policy, custom_reward,
                     mean_action, render, running_state, min_batch_size):
@@ -35,7 +44,7 @@ def collect_samples(pid, queue, env, policy, custom_reward,
             time_step_var = torch.tensor(time_step).long().unsqueeze(0)
             with torch.no_grad():
                 if mean_action:
-                    action = torch.argmax(policy.get_action_prob(state_var, des_var, time_step_var)).unsqueeze(0).numpy()
+                    action = torch.argmax(policy.get_action_prob(state_var, des_var, time_step_var)).numpy()
                 else:
                     action = policy.select_action(state_var, des_var, time_step_var)[0].numpy()
             action = int(action)
@@ -67,6 +76,72 @@ def collect_samples(pid, queue, env, policy, custom_reward,
         return memory, log
 
 
+def collect_samples_batched(pid, queue, env, policy, custom_reward,
+                            mean_action, render, running_state, min_batch_size, num_envs):
+    """same contract as collect_samples, but steps num_envs episodes in lockstep with one policy forward per step"""
+    if pid > 0:
+        torch.manual_seed(torch.randint(0, 5000, (1,)) * pid)
+        if hasattr(env, 'np_random'):
+            env.np_random.seed(env.np_random.randint(5000) * pid)
+        if hasattr(env, 'env') and hasattr(env.env, 'np_random'):
+            env.env.np_random.seed(env.env.np_random.randint(5000) * pid)
+    log = dict()
+    memory = Memory()
+    num_envs = max(1, min(num_envs, min_batch_size))
+    batched_env = BatchedRoadWorld(env, num_envs)
+    batched_env.reset()
+    episode_id = np.arange(num_envs)
+    num_episodes = num_envs
+    active = np.ones(num_envs, dtype=bool)
+    num_steps = 0
+    steps = []
+
+    while active.any():
+        idx = np.flatnonzero(active)
+        state, des, time_step = batched_env.cur_state[idx], batched_env.cur_des[idx], batched_env.cur_time_step[idx]
+        t = batched_env.t[idx]
+        state_var, des_var, time_step_var = torch.from_numpy(state), torch.from_numpy(des), torch.from_numpy(time_step)
+        with torch.no_grad():
+            if mean_action:
+                action = torch.argmax(policy.get_action_prob(state_var, des_var, time_step_var), dim=1).numpy()
+            else:
+                action = policy.select_action(state_var, des_var, time_step_var).numpy()
+        next_state, reward, done = batched_env.step(idx, action)
+        finished = done | (t == 49)
+        mask = (~finished).astype(np.int64)
+        bad_mask = ((next_state != env.pad_idx) & (t != 49)).astype(np.int64)
+        steps.append((episode_id[idx], t, state, des, action, next_state, reward, mask, bad_mask, time_step))
+
+        # a finished slot starts a new episode only while the steps done and in flight stay below min_batch_size
+        for i in idx[finished]:
+            num_steps += batched_env.t[i]
+            if num_steps + batched_env.t[active].sum() - batched_env.t[i] < min_batch_size:
+                batched_env.reset([i])
+                episode_id[i] = num_episodes
+                num_episodes += 1
+            else:
+                active[i] = False
+
+    # lay out the transitions episode by episode, as estimate_advantages expects
+    steps = [np.concatenate(column) for column in zip(*steps)]
+    order = np.lexsort((steps[1], steps[0]))
+    ep, _, state, des, action, next_state, reward, mask, bad_mask, time_step = [column[order] for column in steps]
+    memory.push_batch(state, des, action, next_state, reward, mask, bad_mask, time_step)
+    reward_episode = np.bincount(ep, weights=reward, minlength=num_episodes)
+
+    log['num_steps'] = int(num_steps)
+    log['num_episodes'] = num_episodes
+    log['total_reward'] = reward_episode.sum()
+    log['avg_reward'] = log['total_reward'] / num_episodes
+    log['max_reward'] = reward_episode.max()
+    log['min_reward'] = reward_episode.min()
+
+    if queue is not None:
+        queue.put([pid, memory, log])
+    else:
+        return memory, log
+
+
 def collect_routes_with_OD(pid, batch_od, queue, env, policy, custom_reward,
                     mean_action, render, running_state):
     if pid > 0:
@@ -77,19 +152,18 @@ def collect_routes_with_OD(pid, batch_od, queue, env, policy, custom_reward,
             env.env.np_random.seed(env.env.np_random.randint(5000) * pid)
 
     trajs = []
+    # routes of a call share the policy weights, so every (des, time_step) is evaluated once
+    cache = PolicyTableCache(policy, env.n_states)
     for i in range(batch_od.shape[0]):
         state, des, time_step = env.reset(int(batch_od[i, 0]), int(batch_od[i, 1]))
         reward_episode = 0
-        des_var = torch.tensor(des).long().unsqueeze(0)
-        time_step_var = torch.tensor(time_step).long().unsqueeze(0) # timestep
+        table = cache.table(des, time_step)
         traj = [str(state)]
         for t in range(50):
-            state_var = torch.tensor(state).long().unsqueeze(0)
-            with torch.no_grad():
-                if mean_action:
-                    action = torch.argmax(policy.get_action_prob(state_var, des_var, time_step_var)).unsqueeze(0).numpy()
-                else:
-                    action = policy.select_action(state_var, des_var, time_step_var)[0].numpy()
+            if mean_action:
+                action = torch.argmax(table[state]).item()
+            else:
+                action = torch.distributions.Categorical(table[state]).sample().item()
             action = int(action)
             next_state, _, done = env.step(action)
             if next_state == -1:
@@ -122,78 +196,160 @@ def merge_log(log_list):
     return log
 
 
+def get_worker_result(result_queue, workers, timeout=1.0):
+    """
+    result_queue.get for results of long-lived worker processes: it waits timeout seconds at a time and raises
+    RuntimeError once a worker has exited, instead of blocking forever on a result that will never come
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=timeout)
+        except queue.Empty:
+            dead = [worker for worker in workers if not worker.is_alive()]
+            if dead:
+                try:  # a result put just before the exit may still be in flight
+                    return result_queue.get(timeout=timeout)
+                except queue.Empty:
+                    raise RuntimeError('%s exited with code %s' % (dead[0].name, dead[0].exitcode))
+
+
+def rollout_worker(pid, seed, task_queue, result_queue, env, policy, custom_reward, running_state, num_envs):
+    """long-lived rollout process: env and policy arrive once, policy weights are read from shared memory"""
+    torch.set_num_threads(1)
+    policy = script_policy(policy)  # scripted here, a ScriptModule cannot be pickled to a spawned process
+    torch.manual_seed(seed + pid)
+    np.random.seed(seed + pid)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        if task[0] == 'samples':
+            _, mean_action, min_batch_size = task
+            if num_envs > 1:
+                memory, log = collect_samples_batched(pid, None, env, policy, custom_reward, mean_action, False,
+                                                      running_state, min_batch_size, num_envs)
+            else:
+                memory, log = collect_samples(pid, None, env, policy, custom_reward, mean_action, False,
+                                              running_state, min_batch_size)
+            result_queue.put([pid, memory, log])  # the memory columns travel through shared memory
+        else:
+            _, batch_od, mean_action = task
+            trajs = collect_routes_with_OD(pid, batch_od, None, env, policy, custom_reward, mean_action, False,
+                                           running_state)
+            result_queue.put([pid, trajs])
+
+
+class RolloutWorkerPool:
+    """
+    Persistent rollout processes sharing one CPU copy of the policy.
+    The processes are started once with the env; sync() copies new weights into the shared parameters in place.
+    Rollouts run on rollout_policy, the scripted inference module of that copy (see model.policy.script_policy);
+    the workers receive the eager copy and script it themselves.
+    """
+
+    def __init__(self, env, policy, num_workers, custom_reward=None, running_state=None, num_envs=1):
+        self.policy = copy.deepcopy(policy)
+        to_device(torch.device('cpu'), self.policy)
+        self.policy.to_device(torch.device('cpu'))
+        self.policy.share_memory()
+        self.rollout_policy = script_policy(self.policy)
+        self.result_queue = mp_context.Queue()
+        self.task_queues = []
+        self.workers = []
+        seed = np.random.randint(2 ** 31 - 1 - num_workers)
+        for i in range(num_workers):
+            task_queue = mp_context.Queue()
+            worker_args = (i + 1, seed, task_queue, self.result_queue, env, self.policy, custom_reward,
+                           running_state, num_envs)
+            worker = mp_context.Process(target=rollout_worker, args=worker_args, daemon=True)
+            worker.start()
+            self.task_queues.append(task_queue)
+            self.workers.append(worker)
+
+    def sync(self, policy):
+        self.policy.load_state_dict(policy.state_dict())
+
+    def submit(self, tasks):
+        """send one task per worker, a task is ('samples', mean_action, min_batch_size) or ('routes', batch_od, mean_action)"""
+        for task_queue, task in zip(self.task_queues, tasks):
+            task_queue.put(task)
+
+    def collect(self):
+        results = [None] * len(self.workers)
+        for _ in self.workers:
+            result = get_worker_result(self.result_queue, self.workers)
+            results[result[0] - 1] = result
+        return results
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers, self.task_queues = [], []
+
+
 class Agent:
-    def __init__(self, env, policy, device, custom_reward=None, running_state=None, num_threads=1):
+    def __init__(self, env, policy, device, custom_reward=None, running_state=None, num_threads=1, num_envs=1):
         self.env = env
         self.policy = policy
         self.device = device
         self.custom_reward = custom_reward
         self.running_state = running_state
         self.num_threads = num_threads
+        self.num_envs = num_envs  # episodes stepped in lockstep per thread, 1 keeps the per-episode sampler
+        self.pool = None  # started on first use, holds the CPU rollout copy of the policy
+
+    def _rollout_policy(self):
+        if self.pool is None:
+            self.pool = RolloutWorkerPool(self.env, self.policy, self.num_threads - 1, self.custom_reward,
+                                          self.running_state, self.num_envs)
+        self.pool.sync(self.policy)
+        return self.pool.rollout_policy
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def collect_samples(self, min_batch_size, mean_action=False, render=False):
         t_start = time.time()
-        to_device(torch.device('cpu'), self.policy)
-        self.policy.to_device(torch.device('cpu'))
+        policy = self._rollout_policy()
         thread_batch_size = int(math.floor(min_batch_size / self.num_threads))
-        queue = multiprocessing.Queue()
-        workers = []
-
-        for i in range(self.num_threads - 1):
-            worker_args = (i + 1, queue, self.env, self.policy, self.custom_reward, mean_action,
-                           False, self.running_state, thread_batch_size)
-            workers.append(multiprocessing.Process(target=collect_samples, args=worker_args))
-        for worker in workers:
-            worker.start()
+        self.pool.submit([('samples', mean_action, thread_batch_size)] * (self.num_threads - 1))
+
+        if self.num_envs > 1:
+            memory, log = collect_samples_batched(0, None, self.env, policy, self.custom_reward, mean_action,
+                                                  render, self.running_state, thread_batch_size, self.num_envs)
+        else:
+            memory, log = collect_samples(0, None, self.env, policy, self.custom_reward, mean_action,
+                                          render, self.running_state, thread_batch_size)
 
-        memory, log = collect_samples(0, None, self.env, self.policy, self.custom_reward, mean_action,
-                                      render, self.running_state, thread_batch_size)
-
-        worker_logs = [None] * len(workers)
-        worker_memories = [None] * len(workers)
-        for _ in workers:
-            pid, worker_memory, worker_log = queue.get()
-            worker_memories[pid - 1] = worker_memory
-            worker_logs[pid - 1] = worker_log
-        for worker_memory in worker_memories:
-            memory.append(worker_memory)
-        batch = memory.sample()
+        memories, worker_logs = [memory], []
+        for _, worker_memory, worker_log in self.pool.collect():
+            memories.append(worker_memory)
+            worker_logs.append(worker_log)
+        batch = concat_samples(memories)
         if self.num_threads > 1:
             log_list = [log] + worker_logs
             log = merge_log(log_list)
-        to_device(self.device, self.policy)
-        self.policy.to_device(self.device)
         t_end = time.time()
         log['sample_time'] = t_end - t_start
-        log['action_mean'] = np.mean(np.vstack(batch.action), axis=0)
-        log['action_min'] = np.min(np.vstack(batch.action), axis=0)
-        log['action_max'] = np.max(np.vstack(batch.action), axis=0)
+        actions = batch.action.numpy().reshape(-1, 1)
+        log['action_mean'] = np.mean(actions, axis=0)
+        log['action_min'] = np.min(actions, axis=0)
+        log['action_max'] = np.max(actions, axis=0)
         return batch, log
 
     def collect_routes_with_OD(self, target_od, mean_action=False, render=False):
-        to_device(torch.device('cpu'), self.policy)
-        self.policy.to_device(torch.device('cpu'))
+        policy = self._rollout_policy()
         thread_batch_size = int(math.ceil(target_od.shape[0] / self.num_threads))
         batch_od = [target_od[i*thread_batch_size:min((i+1)*thread_batch_size, target_od.shape[0])]for i in range(self.num_threads)]
-        queue = multiprocessing.Queue()
-        workers = []
-
-        for i in range(self.num_threads - 1):
-            worker_args = (i + 1, batch_od[i+1], queue, self.env, self.policy, self.custom_reward, mean_action,
-                           False, self.running_state)
-            workers.append(multiprocessing.Process(target=collect_routes_with_OD, args=worker_args))
-        for worker in workers:
-            worker.start()
+        self.pool.submit([('routes', batch_od[i + 1], mean_action) for i in range(self.num_threads - 1)])
 
-        trajs = collect_routes_with_OD(0, batch_od[0], None, self.env, self.policy, self.custom_reward, mean_action,
+        trajs = collect_routes_with_OD(0, batch_od[0], None, self.env, policy, self.custom_reward, mean_action,
                                       render, self.running_state)
 
-        worker_trajs = [None] * len(workers)
-        for _ in workers:
-            pid, worker_traj = queue.get()
-            worker_trajs[pid - 1] = worker_traj
-        for worker_traj in worker_trajs:
+        for _, worker_traj in self.pool.collect():
             trajs = trajs + worker_traj
-        to_device(self.device, self.policy)
-        self.policy.to_device(self.device)
-        return trajs
\ No newline at end of file
+        return trajs
@@ -1,28 +1,56 @@
 import torch
 from utils.torch import to_device
+from model.features import select_unique
 
 
 def estimate_advantages(rewards, masks, bad_masks, values, next_values, gamma, tau, device):
-    rewards, masks, bad_masks, values, next_values = to_device(torch.device('cpu'),
-                                                               rewards, masks, bad_masks,
-                                                               values, next_values)
-    tensor_type = type(rewards)
-    deltas = tensor_type(rewards.size(0), 1)
-    advantages = tensor_type(rewards.size(0), 1)
+    """
+    GAE over a batch of consecutive episodes, computed on the device the batch lives on.
+    advantages[i] = bad_masks[i] * (deltas[i] + gamma * tau * masks[i] * advantages[i + 1]) is a linear recurrence
+    A[i] = x[i] + c[i] * A[i + 1]; it is solved by a reverse doubling scan, each pass folds in the next 2^k steps.
+    """
+    values, next_values = values.view(-1, 1), next_values.view(-1, 1)
+    rewards = rewards.view(-1, 1).to(values.dtype)
+    masks = masks.view(-1, 1).to(values.dtype)
+    bad_masks = bad_masks.view(-1, 1).to(values.dtype)
 
-    # prev_value = 0
-    prev_advantage = 0
-    for i in reversed(range(rewards.size(0))):
-        deltas[i] = rewards[i] + gamma * next_values[i] - values[i] # 这一步应该是需要的 因为我等于是到这一步之后 还有一个action 需要这个action是对的才行
-        advantages[i] = deltas[i] + gamma * tau * prev_advantage * masks[i]
+    deltas = rewards + gamma * next_values - values
+    advantages = deltas * bad_masks
+    coef = gamma * tau * masks * bad_masks
 
-        advantages[i] = advantages[i] * bad_masks[i]
-
-        # prev_value = values[i, 0]
-        prev_advantage = advantages[i, 0]
+    offset = 1
+    while offset < advantages.size(0) and bool(coef.any()):
+        pad = torch.zeros_like(coef[:offset])
+        advantages = advantages + torch.cat([coef[:-offset] * advantages[offset:], pad])
+        coef = torch.cat([coef[:-offset] * coef[offset:], pad])
+        offset *= 2
 
     returns = values + advantages
     advantages = (advantages - advantages.mean()) / advantages.std()
 
     advantages, returns = to_device(device, advantages, returns)
-    return advantages, returns
\ No newline at end of file
+    return advantages, returns
+
+
+class ExpertDataset(object):
+    """
+    The expert transitions with their discriminator inputs (FeatureBuilder.build_unique, once per distinct triple)
+    computed once and kept on the training device; minibatches are drawn without replacement by a permutation
+    generated on that device.
+    """
+
+    def __init__(self, feature_builder, states, destinations, actions, next_states, time_steps, device):
+        self.device = device
+        states, destinations, actions, next_states, time_steps = \
+            to_device(device, states, destinations, actions, next_states, time_steps)
+        self.actions = actions
+        with torch.no_grad():
+            self.unique = feature_builder.build_unique(states, destinations, time_steps, next_states)
+
+    def __len__(self):
+        return self.actions.size(0)
+
+    def sample(self, batch_size):
+        """UniqueFeatures and actions of min(batch_size, len(self)) distinct expert transitions"""
+        index = torch.randperm(len(self), device=self.device)[:batch_size]
+        return select_unique(self.unique, index), self.actions[index]
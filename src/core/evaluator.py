@@ -0,0 +1,93 @@
+import copy
+import os
+import queue
+import torch
+from core.agent import collect_routes_with_OD, get_worker_result, mp_context
+from utils.torch import to_device
+from model.policy import script_policy
+from utils.evaluation import evaluate_train_edit_dist
+
+
+def evaluation_worker(task_queue, result_queue, env, policy, test_od, test_trajs, model_path, best_edit, num_threads):
+    """long-lived evaluation process: greedy routes of test_od under each weight snapshot, scored by edit distance"""
+    torch.set_num_threads(num_threads)
+    route_policy = script_policy(policy)  # shares the weights loaded into policy below
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        i_iter, state_dicts = task
+        policy.load_state_dict(state_dicts['Policy'])
+        learner_trajs = collect_routes_with_OD(0, test_od, None, env, route_policy, None, True, False, None)
+        edit_dist = evaluate_train_edit_dist(test_trajs, learner_trajs)
+        saved = bool(edit_dist < best_edit)
+        if saved:
+            best_edit = edit_dist
+            tmp_path = model_path + '.tmp'
+            torch.save(state_dicts, tmp_path)
+            os.replace(tmp_path, model_path)  # load_model never sees a half written checkpoint
+        result_queue.put((i_iter, edit_dist, best_edit, saved))
+
+
+class AsyncEvaluator:
+    """
+    Edit distance evaluation in a background process, so training does not stop at every log interval.
+    submit() hands over a CPU snapshot of the weights; the process keeps the best snapshot at model_path.
+    At most max_pending snapshots wait in the queue, submit() blocks on the oldest result beyond that.
+    The process is spawned (core.agent.mp_context) with an eager CPU copy of the policy, snapshots are CPU state dicts.
+    """
+
+    def __init__(self, env, policy, test_od, test_trajs, model_path, best_edit=1.0, max_pending=2, num_threads=1):
+        eval_policy = copy.deepcopy(policy)
+        to_device(torch.device('cpu'), eval_policy)
+        eval_policy.to_device(torch.device('cpu'))
+        self.task_queue = mp_context.Queue()
+        self.result_queue = mp_context.Queue()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.results = []  # arrived but not yet handed out by poll()
+        worker_args = (self.task_queue, self.result_queue, env, eval_policy, test_od, test_trajs, model_path,
+                       best_edit, num_threads)
+        self.worker = mp_context.Process(target=evaluation_worker, args=worker_args, daemon=True)
+        self.worker.start()
+
+    def submit(self, i_iter, nets):
+        """snapshot nets ({'Policy': policy_net, 'Value': value_net, ...}) and queue their evaluation at i_iter"""
+        while self.pending >= self.max_pending:
+            self._receive(block=True)
+        state_dicts = {name: {k: v.detach().cpu().clone() for k, v in net.state_dict().items()}
+                       for name, net in nets.items()}
+        self.task_queue.put((i_iter, state_dicts))
+        self.pending += 1
+
+    def _receive(self, block):
+        try:
+            if block:  # raises RuntimeError if the evaluation process has died
+                result = get_worker_result(self.result_queue, [self.worker])
+            else:
+                result = self.result_queue.get(block=False)
+        except queue.Empty:
+            return False
+        self.pending -= 1
+        self.results.append(result)
+        return True
+
+    def poll(self):
+        """(i_iter, edit_dist, best_edit, saved) of the evaluations finished so far, without waiting"""
+        while self.pending > 0 and self._receive(block=False):
+            pass
+        results, self.results = self.results, []
+        return results
+
+    def wait(self):
+        """results of all submitted evaluations"""
+        while self.pending > 0:
+            self._receive(block=True)
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        if self.worker is not None:
+            self.task_queue.put(None)
+            self.worker.join()
+            self.worker = None
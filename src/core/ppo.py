@@ -1,27 +1,48 @@
 import torch
+from model.features import select_unique
 
 
-def ppo_step(policy_net, value_net, optimizer_policy, optimizer_value, optim_value_iternum, states, destinations,
-             actions, returns, advantages, fixed_log_probs, clip_epsilon, l2_reg, max_grad_norm, time_steps):
+def minibatch_indices(n, batch_size, device=None):
+    """row indices of the minibatches of one epoch: slices of a single permutation, the batch itself is not copied"""
+    return torch.split(torch.randperm(n, device=device), batch_size)
+
+
+def ppo_step_features(policy_net, value_net, optimizer_policy, optimizer_value, optim_value_iternum, unique,
+                      actions, returns, advantages, fixed_log_probs, clip_epsilon, l2_reg, max_grad_norm, micro_batches):
+    """
+    clipped PPO update of the value and policy networks on the precomputed UniqueFeatures of the whole rollout batch
+    (see FeatureBuilder.build_unique), the networks run once per distinct triple of a micro batch.
+    micro_batches are the row indices of one minibatch; their gradients are accumulated, weighted by their size,
+    into a single optimizer step, so a large minibatch needs the memory of one micro batch only.
+    """
+    n = sum(rows.size(0) for rows in micro_batches)
     value_loss, policy_surr = None, None
     """update critic"""
     for _ in range(optim_value_iternum):
-        values_pred = value_net(states, destinations, time_steps)
-        value_loss = (values_pred - returns).pow(2).mean()
         optimizer_value.zero_grad()
-        value_loss.backward()
+        value_loss = 0
+        for rows in micro_batches:
+            batch = select_unique(unique, rows, with_next=False)
+            values_pred = value_net.forward_features(batch.features.state)[batch.state_index]
+            loss = (values_pred - returns[rows]).pow(2).sum() / n
+            loss.backward()
+            value_loss += loss.detach()
         torch.nn.utils.clip_grad_norm_(value_net.parameters(), max_grad_norm)
         optimizer_value.step()
 
     """update policy"""
-    log_probs = policy_net.get_log_prob(states, destinations, actions, time_steps)
-    ratio = torch.exp(log_probs - fixed_log_probs)
-    surr1 = ratio * advantages
-    surr2 = torch.clamp(ratio, 1.0 - clip_epsilon, 1.0 + clip_epsilon) * advantages
-    policy_surr = -torch.min(surr1, surr2).mean()
     optimizer_policy.zero_grad()
-    policy_surr.backward()
+    policy_surr = 0
+    for rows in micro_batches:
+        batch = select_unique(unique, rows, with_next=False)
+        log_probs = policy_net.get_log_prob_features(batch.features, actions[rows], batch.state_index)
+        ratio = torch.exp(log_probs - fixed_log_probs[rows])
+        surr1 = ratio * advantages[rows]
+        surr2 = torch.clamp(ratio, 1.0 - clip_epsilon, 1.0 + clip_epsilon) * advantages[rows]
+        loss = -torch.min(surr1, surr2).sum() / n
+        loss.backward()
+        policy_surr += loss.detach()
     torch.nn.utils.clip_grad_norm_(policy_net.parameters(), max_grad_norm)
     optimizer_policy.step()
 
-    return value_loss, policy_surr
\ No newline at end of file
+    return value_loss, policy_surr
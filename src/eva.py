@@ -1,32 +1,27 @@
-import numpy as np
 import torch
-from network_env import RoadWorld
-from utils.load_data import load_test_traj, ini_od_dist, load_path_feature, load_link_feature, minmax_normalization
 from model.policy import PolicyCNN
 from model.value import ValueCNN
 from model.discriminator import DiscriminatorAIRLCNN
-from core.agent import Agent
-from utils.evaluation import evaluate_model
-import pandas as pd
+from model.features import FeatureBuilder
 
 
 
-def load_model(model_path, device, env, path_feature_pad, edge_feature_pad):
+def load_model(model_path, device, env, path_feature_pad, edge_feature_pad, speed_feature):
     # Assuming the dimensions for the models based on training setup
     gamma = 0.99  # discount factor
-    edge_data = pd.read_csv('../data/speed/updated_edges.txt')
-    speed_data = {(row['n_id'], row['time_step']): row['speed'] for _, row in edge_data.iterrows()}
+    feature_builder = FeatureBuilder(env.policy_mask, env.state_action, path_feature_pad, edge_feature_pad, speed_feature)
     policy_net = PolicyCNN(env.n_actions, env.policy_mask, env.state_action,
                            path_feature_pad, edge_feature_pad,
                            path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
-                           env.pad_idx,speed_data).to(device)
+                           env.pad_idx, speed_feature, feature_builder).to(device)
     value_net = ValueCNN(path_feature_pad, edge_feature_pad,
-                         path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],speed_data=speed_data).to(device)
+                         path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],speed_feature=speed_feature,
+                         feature_builder=feature_builder).to(device)
     discrim_net = DiscriminatorAIRLCNN(env.n_actions, gamma, env.policy_mask,
                                        env.state_action, path_feature_pad, edge_feature_pad,
                                        path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
                                        path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],
-                                       env.pad_idx,speed_data).to(device)
+                                       env.pad_idx, speed_feature, feature_builder).to(device)
 
     model_dict = torch.load(model_path, map_location=device)
     policy_net.load_state_dict(model_dict['Policy'])
@@ -35,39 +30,58 @@ def load_model(model_path, device, env, path_feature_pad, edge_feature_pad):
 
     return policy_net, value_net, discrim_net
 
+class Evaluator(object):
+    """
+    Route evaluation of a trained model on the test data.
+    The data and the networks are loaded by setup(), which evaluate() calls on first use.
+    """
+
+    def __init__(self, model_path="../trained_models/airl_CV0_size10000.pt",
+                 test_p="../data/base/cross_validation/test_CV0.csv", bundle_p="../data/bundle/test_CV0", device=None):
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
+
+        # Path settings
+        self.model_path = model_path
+        self.test_p = test_p
+        self.edge_p = "../data/base/edge.txt"
+        self.network_p = "../data/base/transit.npy"
+        self.path_feature_p = "../data/direction/feature_od_direction.npy"
+        self.speed_p = "../data/speed/updated_edges.txt"
+        self.bundle_p = bundle_p
+        self.env = None
+
+    def setup(self):
+        if self.env is not None:
+            return
+        from utils.dataset_bundle import load_dataset_bundle
+        # Initialize environment and load the normalized features, compiled into bundle_p on first use
+        bundle = load_dataset_bundle(self.bundle_p, self.edge_p, self.network_p, self.speed_p, self.test_p,
+                                     self.path_feature_p)
+        env = bundle.road_world(self.network_p, self.edge_p)
+
+        # Load the model
+        self.policy_net, self.value_net, self.discrim_net = load_model(self.model_path, self.device, env,
+                                                                       bundle.path_feature, bundle.edge_feature,
+                                                                       bundle.speed_feature)
+        self.env = env
+
+    def evaluate(self):
+        from utils.load_data import load_test_traj
+        from utils.evaluation import evaluate_model
+        from utils.policy_cache import PolicyTableCache
+        self.setup()
+
+        # Load test trajectories
+        test_trajs, test_od = load_test_traj(self.test_p)
+
+        # Evaluate the model
+        evaluate_model(test_od, test_trajs, self.policy_net, self.env,
+                       cache=PolicyTableCache(self.policy_net, self.env.n_states))
+
+
 def evaluate_only():
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    
-    # Path settings
-    model_path = "../trained_models/airl_CV0_size10000.pt"  
-    test_p = "../data/cross_validation/test_CV0.csv"  # Adjust path and CV index as necessary
-    edge_p = "../data/base/edge.txt"
-    network_p = "../data/base/transit.npy"
-    path_feature_p = "../data/direction/feature_od_direction.npy"
-    test_p = "../data/base/cross_validation/test_CV0.csv"
-
-    # Initialize environment
-    od_list, od_dist = ini_od_dist(test_p)
-    env = RoadWorld(network_p, edge_p, pre_reset=(od_list, od_dist))
-
-    # Load features and normalize
-    path_feature, path_max, path_min = load_path_feature(path_feature_p)
-    edge_feature, link_max, link_min = load_link_feature(edge_p)
-    path_feature = minmax_normalization(path_feature, path_max, path_min)
-    path_feature_pad = np.zeros((env.n_states, env.n_states, path_feature.shape[2]))
-    path_feature_pad[:path_feature.shape[0], :path_feature.shape[1], :] = path_feature
-    edge_feature = minmax_normalization(edge_feature, link_max, link_min)
-    edge_feature_pad = np.zeros((env.n_states, edge_feature.shape[1]))
-    edge_feature_pad[:edge_feature.shape[0], :] = edge_feature
-
-    # Load the model
-    policy_net, value_net, discrim_net = load_model(model_path, device, env, path_feature_pad, edge_feature_pad)
-
-    # Load test trajectories
-    test_trajs, test_od = load_test_traj(test_p)
-
-    # Evaluate the model
-    evaluate_model(test_od, test_trajs, policy_net, env)
+    Evaluator().evaluate()
+
 
 if __name__ == '__main__':
     evaluate_only()
@@ -3,26 +3,20 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 torch.backends.cudnn.enabled = False
-import pandas as pd
+from utils.torch import gather_speed
+from utils.feature_store import as_path_feature_store
+from model.features import FeatureBuilder, FeatureTables
 
 
-class DiscriminatorAIRLCNN(nn.Module):
+class DiscriminatorAIRLCNN(FeatureTables, nn.Module):
     def __init__(self, action_num, gamma, policy_mask, action_state, path_feature, link_feature, rs_input_dim,
-                 hs_input_dim, pad_idx=None, speed_data=None):
+                 hs_input_dim, pad_idx=None, speed_feature=None, feature_builder=None):
         super(DiscriminatorAIRLCNN, self).__init__()
 
-        # Load speed data
-        self.speed_data = speed_data
-
         self.gamma = gamma
-        self.policy_mask = torch.from_numpy(policy_mask).long()
-        policy_mask_pad = np.concatenate([policy_mask, np.zeros((policy_mask.shape[0], 1), dtype=np.int32)], 1)
-        self.policy_mask_pad = torch.from_numpy(policy_mask_pad).long()
-        action_state_pad = np.concatenate([action_state, np.expand_dims(np.arange(action_state.shape[0]), 1)], 1)
-        self.action_state_pad = torch.from_numpy(action_state_pad).long()
-        self.path_feature = torch.from_numpy(path_feature).float()
-        self.link_feature = torch.from_numpy(link_feature).float()
-        self.new_index = torch.tensor([7, 0, 1, 6, 8, 2, 5, 4, 3]).long()
+        # policy mask, neighbour layout, path / link features and speed table, see FeatureTables
+        self.feature_builder = feature_builder if feature_builder is not None else \
+            FeatureBuilder(policy_mask, action_state, path_feature, link_feature, speed_feature)
 
         self.pad_idx = pad_idx
         self.action_num = action_num
@@ -43,86 +37,53 @@ class DiscriminatorAIRLCNN(nn.Module):
         self.conv1 = nn.Conv2d(rs_input_dim + 1, 20, 3, padding=1)
         self.h_fc1 = nn.Linear(hs_input_dim + 1, 120)
 
-    def to_device(self, device):
-        self.policy_mask = self.policy_mask.to(device)
-        self.policy_mask_pad = self.policy_mask_pad.to(device)
-        self.action_state_pad = self.action_state_pad.to(device)
-        self.path_feature = self.path_feature.to(device)
-        self.link_feature = self.link_feature.to(device)
-        self.new_index = self.new_index.to(device)
-
     def process_neigh_features(self, state, des, time_step):
-        state_neighbor = self.action_state_pad[state]
-        neigh_path_feature = self.path_feature[state_neighbor, des.unsqueeze(1).repeat(1, self.action_num + 1),
-                             :]
-        neigh_edge_feature = self.link_feature[state_neighbor, :]
-        neigh_mask_feature = self.policy_mask_pad[state].unsqueeze(-1)  # [batch_size, 9, 1]
-
-        # # Extract weather feature from the first dimension of state_neighbor
-        # weather_feature = neigh_path_feature[:, :, 0].unsqueeze(-1).float()
-         # Get speed features
-        speed_features = []
-        for i in range(state.size(0)):
-            speed_row = []
-            for neighbor in state_neighbor[i]:
-                speed = self.speed_data.get((neighbor.item(), time_step[i].item()), 0)  # Default to 0 if not found
-                speed_row.append(speed)
-            speed_features.append(speed_row)
-        speed_feature = torch.tensor(speed_features, dtype=torch.float32, device=state.device).unsqueeze(-1)
-
-        neigh_feature = torch.cat([speed_feature, neigh_path_feature, neigh_edge_feature, neigh_mask_feature], -1)
-
-        # neigh_feature = torch.cat([neigh_path_feature, neigh_edge_feature, neigh_mask_feature],
-        #                           -1)
-        neigh_feature = neigh_feature[:, self.new_index, :]
-        x = neigh_feature.view(state.size(0), 3, 3, -1)
-        x = x.permute(0, 3, 1, 2)
-        return x
+        return self.neigh_layout.features(state, des, time_step, self.path_feature, self.speed_feature)
 
     def process_state_features(self, state, des, time_step):
-        path_feature = self.path_feature[state, des, :]  # 实在不行你也可以把第一个dimension拉平然后reshape 一下
+        path_feature = self.path_feature.gather(state, des)  # 实在不行你也可以把第一个dimension拉平然后reshape 一下
         edge_feature = self.link_feature[state, :]
 
         # # Extract weather feature from the first dimension of path_feature
         # weather_feature = path_feature[:, 0].unsqueeze(-1)
-            # Get speed features
-        speed_features = []
-        for i in range(state.size(0)):
-            speed = self.speed_data.get((state[i].item(), time_step[i].item()), 0)  # Default to 0 if not found
-            speed_features.append(speed)
-        speed_feature = torch.tensor(speed_features, dtype=torch.float32, device=state.device).unsqueeze(-1)
+        # Get speed features
+        speed_feature = gather_speed(self.speed_feature, state, time_step).unsqueeze(-1)
 
-    
         # Concatenate weather_feature, path_feature, and edge_feature
         feature = torch.cat([speed_feature, path_feature, edge_feature], -1)
         # feature = torch.cat([path_feature, edge_feature], -1)  # [batch_size, n_path_feature + n_edge_feature]
         return feature
 
     def f(self, state, des, act, next_state, time_step):
+        return self._f(self.process_neigh_features(state, des, time_step),
+                       self.process_state_features(state, des, time_step),
+                       self.process_state_features(next_state, des, time_step), act)
+
+    def _f(self, x, x_state, next_x_state, act):
         """rs"""
-        x = self.process_neigh_features(state, des, time_step)
+        rs = self._rs(self._rs_conv(x), act)
+        """hs"""
+        x_state = self._h(x_state)
+        """hs_next"""
+        next_x_state = self._h(next_x_state)
+        return rs + self.gamma * next_x_state - x_state
+
+    def _rs_conv(self, x):
         x = self.pool(F.leaky_relu(self.conv1(x), 0.2))
         x = F.leaky_relu(self.conv2(x), 0.2)
-        x = x.view(-1, 30)  # 到这一步等于是对这个3x3的图提取feature
+        return x.view(-1, 30)  # 到这一步等于是对这个3x3的图提取feature
+
+    def _rs(self, x, act):
         x_act = F.one_hot(act, num_classes=self.action_num)
         x = torch.cat([x, x_act], 1)  # [batch_size, 38]
         x = F.leaky_relu(self.fc1(x), 0.2)
         x = F.leaky_relu(self.fc2(x), 0.2)  # 我个人的建议是你先把它按照图像处理完
-        rs = self.fc3(x)
+        return self.fc3(x)
 
-        """hs"""
-        x_state = self.process_state_features(state, des, time_step)
+    def _h(self, x_state):
         x_state = F.leaky_relu(self.h_fc1(x_state), 0.2)
         x_state = F.leaky_relu(self.h_fc2(x_state), 0.2)
-        x_state = self.h_fc3(x_state)
-
-        """hs_next"""
-        next_x_state = self.process_state_features(next_state, des, time_step)
-        next_x_state = F.leaky_relu(self.h_fc1(next_x_state), 0.2)
-        next_x_state = F.leaky_relu(self.h_fc2(next_x_state), 0.2)
-        next_x_state = self.h_fc3(next_x_state)
-
-        return rs + self.gamma * next_x_state - x_state
+        return self.h_fc3(x_state)
 
     def forward(self, states, des, act, log_pis, next_states, time_steps):
         # Discriminator's output is sigmoid(f - log_pi).
@@ -132,18 +93,37 @@ class DiscriminatorAIRLCNN(nn.Module):
         with torch.no_grad():
             logits = self.forward(states, des, act, log_pis, next_states, time_steps)
             return -F.logsigmoid(-logits)
+
+    def forward_features(self, features, act, log_pis):
+        """forward on the BatchFeatures of model.features.FeatureBuilder"""
+        return self._f(features.neigh, features.state, features.next_state, act) - log_pis
+
+    def calculate_reward_features(self, features, act, log_pis):
+        with torch.no_grad():
+            return -F.logsigmoid(-self.forward_features(features, act, log_pis))
+
+    def forward_unique(self, unique, act, log_pis):
+        """forward on the UniqueFeatures of model.features: the conv and h networks run once per distinct triple"""
+        features = unique.features
+        rs = self._rs(self._rs_conv(features.neigh)[unique.state_index], act)
+        h, next_h = self._h(features.state), self._h(features.next_state)
+        return rs + self.gamma * next_h[unique.next_index] - h[unique.state_index] - log_pis
+
+    def calculate_reward_unique(self, unique, act, log_pis):
+        with torch.no_grad():
+            return -F.logsigmoid(-self.forward_unique(unique, act, log_pis))
         
 
     def get_single_input_features(self, state, des, action, next_state):
         state_neighbor = self.action_state_pad[state]
-        neigh_path_feature = self.path_feature[state_neighbor, des.unsqueeze(1).repeat(1, self.action_num + 1), :]
+        neigh_path_feature = self.path_feature.gather(state_neighbor, des.unsqueeze(1))
         neigh_edge_feature = self.link_feature[state_neighbor, :]
 
       
-        current_path_feature = self.path_feature[state, des, :]
+        current_path_feature = self.path_feature.gather(state, des)
         current_edge_feature = self.link_feature[state, :]
 
-        next_path_feature = self.path_feature[next_state, des, :]
+        next_path_feature = self.path_feature.gather(next_state, des)
         # print('next_path_feature',next_path_feature)
         next_edge_feature = self.link_feature[next_state, :]
 
@@ -153,7 +133,7 @@ class DiscriminatorAIRLCNN(nn.Module):
     
     def get_input_features(self, state, des, action, next_state):
         state_neighbor = self.action_state_pad[state]
-        neigh_path_feature = self.path_feature[state_neighbor, des.unsqueeze(1).repeat(1, self.action_num + 1), :]
+        neigh_path_feature = self.path_feature.gather(state_neighbor, des.unsqueeze(1))
         neigh_edge_feature = self.link_feature[state_neighbor, :]
 
         # print('state',state)
@@ -163,7 +143,7 @@ class DiscriminatorAIRLCNN(nn.Module):
         # print('current_path_feature',current_path_feature)
         current_edge_feature = neigh_edge_feature[:, action, :][0,-1,:]
 
-        next_path_feature = self.path_feature[next_state, des, :]
+        next_path_feature = self.path_feature.gather(next_state, des)
         # print('next_path_feature',next_path_feature)
         next_edge_feature = self.link_feature[next_state, :]
 
@@ -176,11 +156,7 @@ class DiscriminatorAIRLCNN(nn.Module):
         neigh_mask_feature = self.policy_mask_pad[self.cur_state].unsqueeze(-1)  # [batch_size, 9, 1]
 
         # Get speed features for the current state
-        speed_features = []
-        for i in range(self.cur_state.size(0)):
-            speed = self.speed_data.get((self.cur_state[i].item(), time_step[i].item()), 0)  # Default to 0 if not found
-            speed_features.append(speed)
-        speed_feature = torch.tensor(speed_features, dtype=torch.float32, device=self.cur_state.device).unsqueeze(-1)
+        speed_feature = gather_speed(self.speed_feature, self.cur_state, time_step).unsqueeze(-1)
 
         # Ensure all features have the correct shape
         speed_feature = speed_feature.view(1, 1, -1)  # [1, 1, feature_size]
@@ -216,11 +192,7 @@ class DiscriminatorAIRLCNN(nn.Module):
         x_state = self.h_fc3(x_state)
 
         # Get speed features for the next state
-        next_speed_features = []
-        for i in range(self.cur_state.size(0)):
-            next_speed = self.speed_data.get((self.cur_state[i].item(), time_step[i].item()), 0)  # Default to 0 if not found
-            next_speed_features.append(next_speed)
-        next_speed_feature = torch.tensor(next_speed_features, dtype=torch.float32, device=self.cur_state.device).unsqueeze(-1)
+        next_speed_feature = gather_speed(self.speed_feature, self.cur_state, time_step).unsqueeze(-1)
 
         # Ensure next state features have the correct shape
         next_speed_feature = next_speed_feature.view(1, 1, -1)  # [1, 1, feature_size]
@@ -244,7 +216,7 @@ class DiscriminatorCNN(nn.Module):
         self.policy_mask_pad = torch.from_numpy(policy_mask_pad).long()
         action_state_pad = np.concatenate([action_state, np.expand_dims(np.arange(action_state.shape[0]), 1)], 1)
         self.action_state_pad = torch.from_numpy(action_state_pad).long()
-        self.path_feature = torch.from_numpy(path_feature).float()
+        self.path_feature = as_path_feature_store(path_feature)
         self.link_feature = torch.from_numpy(link_feature).float()
         self.new_index = torch.tensor([7, 0, 1, 6, 8, 2, 5, 4, 3]).long()
         self.pad_idx = pad_idx
@@ -267,7 +239,7 @@ class DiscriminatorCNN(nn.Module):
 
     def process_features(self, state, des):
         state_neighbor = self.action_state_pad[state]
-        neigh_path_feature = self.path_feature[state_neighbor, des.unsqueeze(1).repeat(1, self.action_num + 1), :]
+        neigh_path_feature = self.path_feature.gather(state_neighbor, des.unsqueeze(1))
         neigh_edge_feature = self.link_feature[state_neighbor, :]
         neigh_mask_feature = self.policy_mask_pad[state].unsqueeze(-1)  # [batch_size, 9, 1]
         neigh_feature = torch.cat([neigh_path_feature, neigh_edge_feature, neigh_mask_feature],
@@ -0,0 +1,164 @@
+from collections import namedtuple
+import numpy as np
+import torch
+from utils.torch import gather_speed, speed_table
+from utils.feature_store import as_path_feature_store
+
+# neigh: [batch, C, 3, 3] input of the policy / reward CNNs, mask: [batch, n_actions] valid actions,
+# state / next_state: [batch, C - 1] inputs of the value and potential (h) networks
+BatchFeatures = namedtuple('BatchFeatures', ('neigh', 'mask', 'state', 'next_state'))
+# features: BatchFeatures of the distinct (link, destination, time_step) triples of the states of a batch, with
+# next_state holding the state features of the distinct next state triples (deduplicated on their own);
+# state_index / next_index: the row of every state / next state of the batch in features.state / features.next_state
+# (next_state and next_index are None when only the states are needed)
+UniqueFeatures = namedtuple('UniqueFeatures', ('features', 'state_index', 'next_index'))
+
+
+class NeighbourLayout(object):
+    """
+    The 3x3 neighbour grid of every state, precomputed once: the neighbour links in grid order (action_state_pad
+    reordered by new_index) and the static link feature + action mask channels [n_states, 9, C_static].
+    Per batch only the destination path features and the time step speeds are gathered; the NCHW input is one
+    torch.cat, written into a reused buffer when the caller does not keep it (reuse_buffer=True, no autograd).
+    The input is laid out channels last in memory, the layout the CPU convolutions run fastest on.
+    """
+
+    def __init__(self, action_state_pad, policy_mask_pad, link_feature, new_index):
+        self.neighbor = action_state_pad[:, new_index]  # [n_states, 9]
+        mask_feature = policy_mask_pad[:, new_index].unsqueeze(-1).to(link_feature.dtype)
+        self.static = torch.cat([link_feature[self.neighbor], mask_feature], -1)
+        self.buffer = None
+
+    def to_device(self, device):
+        self.neighbor = self.neighbor.to(device)
+        self.static = self.static.to(device)
+        self.buffer = None
+
+    def features(self, state, des, time_step, path_feature, speed_feature, reuse_buffer=False):
+        """[batch, 1 + F + C_static, 3, 3]: speed, path features, link features and action mask of the 9 cells"""
+        neighbor = self.neighbor[state]
+        speed = gather_speed(speed_feature, neighbor, time_step.unsqueeze(1)).unsqueeze(-1)
+        path = path_feature.gather(neighbor, des.unsqueeze(1))
+        out = None
+        if reuse_buffer:
+            shape = (state.size(0), 9, 1 + path.size(-1) + self.static.size(-1))
+            numel = shape[0] * shape[1] * shape[2]
+            if self.buffer is None or self.buffer.numel() < numel or self.buffer.device != state.device:
+                self.buffer = torch.empty(numel, device=state.device)
+            out = self.buffer[:numel].view(shape)
+        x = torch.cat([speed, path, self.static[state]], -1, out=out)
+        return x.view(state.size(0), 3, 3, -1).permute(0, 3, 1, 2)
+
+
+class FeatureBuilder(object):
+    """
+    The input features of PolicyCNN, ValueCNN and DiscriminatorAIRLCNN, built once per batch and shared by the three
+    networks (see their *_features methods) instead of being gathered again by every call.
+    The state vector is the centre cell of the 3x3 neighbour grid, so only the next state needs its own gather.
+    """
+
+    def __init__(self, policy_mask, action_state, path_feature, link_feature, speed_feature):
+        self.path_feature = as_path_feature_store(path_feature)
+        self.link_feature = torch.from_numpy(link_feature).float()
+        # dense [n_states, n_time_steps + 1] speed table, see load_speed_feature
+        self.speed_feature = speed_table(speed_feature)
+        # without policy_mask / action_state only the state features are built (ValueCNN)
+        self.policy_mask, self.policy_mask_pad, self.action_state_pad, self.new_index = None, None, None, None
+        self.neigh_layout = None
+        if policy_mask is not None:
+            self.policy_mask = torch.from_numpy(policy_mask).long()
+            policy_mask_pad = np.concatenate([policy_mask, np.zeros((policy_mask.shape[0], 1), dtype=np.int32)], 1)
+            self.policy_mask_pad = torch.from_numpy(policy_mask_pad).long()
+            action_state_pad = np.concatenate([action_state, np.expand_dims(np.arange(action_state.shape[0]), 1)], 1)
+            self.action_state_pad = torch.from_numpy(action_state_pad).long()
+            self.new_index = torch.tensor([7, 0, 1, 6, 8, 2, 5, 4, 3]).long()
+            self.neigh_layout = NeighbourLayout(self.action_state_pad, self.policy_mask_pad, self.link_feature,
+                                                self.new_index)
+
+    def to_device(self, device):
+        for name in ('policy_mask', 'policy_mask_pad', 'action_state_pad', 'path_feature', 'link_feature',
+                     'speed_feature', 'new_index'):
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).to(device))
+        if self.neigh_layout is not None:
+            self.neigh_layout.to_device(device)
+
+    def neigh_features(self, state, des, time_step):
+        """same as PolicyCNN.process_features"""
+        return self.neigh_layout.features(state, des, time_step, self.path_feature, self.speed_feature)
+
+    def state_features(self, state, des, time_step):
+        """same as ValueCNN.process_features"""
+        path_feature = self.path_feature.gather(state, des)
+        edge_feature = self.link_feature[state, :]
+        speed_feature = gather_speed(self.speed_feature, state, time_step).unsqueeze(-1)
+        return torch.cat([speed_feature, path_feature, edge_feature], -1)
+
+    def build(self, state, des, time_step, next_state=None):
+        neigh = self.neigh_features(state, des, time_step)
+        # the centre cell is the state itself (last column of action_state_pad), without the mask channel
+        state_feature = neigh[:, :-1, 1, 1]
+        next_state_feature = None if next_state is None else self.state_features(next_state, des, time_step)
+        return BatchFeatures(neigh, self.policy_mask[state], state_feature, next_state_feature)
+
+    def build_unique(self, state, des, time_step, next_state):
+        """
+        UniqueFeatures of a batch: the neighbour grids are built once per distinct state triple, and only the state
+        feature rows once per distinct next state triple (the h / value networks are all that read the next state).
+        A network evaluated on them is scattered back to the batch by indexing its output with state_index /
+        next_index; the backward of the indexing sums the gradients of repeated rows onto their triple.
+        """
+        first, state_index = unique_triples(state, des, time_step)
+        features = self.build(state[first], des[first], time_step[first])
+        first, next_index = unique_triples(next_state, des, time_step)
+        next_feature = self.state_features(next_state[first], des[first], time_step[first])
+        return UniqueFeatures(features._replace(next_state=next_feature), state_index, next_index)
+
+
+def _table(name):
+    return property(lambda self: getattr(self.feature_builder, name))
+
+
+class FeatureTables(object):
+    """
+    The feature tables of PolicyCNN, ValueCNN and DiscriminatorAIRLCNN, read from their FeatureBuilder
+    (self.feature_builder). Networks given the same FeatureBuilder share one copy of the tables on the device.
+    """
+    policy_mask = _table('policy_mask')
+    policy_mask_pad = _table('policy_mask_pad')
+    action_state_pad = _table('action_state_pad')
+    path_feature = _table('path_feature')
+    link_feature = _table('link_feature')
+    speed_feature = _table('speed_feature')
+    new_index = _table('new_index')
+    neigh_layout = _table('neigh_layout')
+
+    def to_device(self, device):
+        self.feature_builder.to_device(device)
+
+
+def unique_triples(link, des, time_step):
+    """one row of every distinct (link, destination, time_step) triple and the inverse index of all rows into them"""
+    time_step = time_step - time_step.min()
+    key = (link * (des.max() + 1) + des) * (time_step.max() + 1) + time_step
+    key, inverse = torch.unique(key, return_inverse=True)
+    first = torch.empty_like(key).scatter_(0, inverse, torch.arange(link.size(0), device=link.device))
+    return first, inverse
+
+
+def index_features(features, index):
+    """the BatchFeatures of the rows index (the neighbour grid keeps its channels last memory layout)"""
+    neigh = features.neigh.permute(0, 2, 3, 1)[index].permute(0, 3, 1, 2)
+    next_state = None if features.next_state is None else features.next_state[index]
+    return BatchFeatures(neigh, features.mask[index], features.state[index], next_state)
+
+
+def select_unique(unique, rows, with_next=True):
+    """the UniqueFeatures of the batch rows `rows`, reduced to the state and next state triples these rows use"""
+    used, state_index = torch.unique(unique.state_index[rows], return_inverse=True)
+    features = index_features(unique.features._replace(next_state=None), used)
+    next_index = None
+    if with_next:
+        next_used, next_index = torch.unique(unique.next_index[rows], return_inverse=True)
+        features = features._replace(next_state=unique.features.next_state[next_used])
+    return UniqueFeatures(features, state_index, next_index)
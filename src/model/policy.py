@@ -1,27 +1,19 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 torch.backends.cudnn.enabled = False
-import pandas as pd
+from utils.torch import gather_speed
+from utils.feature_store import PathFeatureStore
+from model.features import FeatureBuilder, FeatureTables
 
 
-class PolicyCNN(nn.Module):
-    def __init__(self, action_num, policy_mask, action_state, path_feature, link_feature, input_dim, pad_idx=None, speed_data=None):
+class PolicyCNN(FeatureTables, nn.Module):
+    def __init__(self, action_num, policy_mask, action_state, path_feature, link_feature, input_dim, pad_idx=None, speed_feature=None, feature_builder=None):
         super(PolicyCNN, self).__init__()
 
-        # Load speed data
-        self.speed_data = speed_data
-
-        self.policy_mask = torch.from_numpy(policy_mask).long()
-        policy_mask_pad = np.concatenate([policy_mask, np.zeros((policy_mask.shape[0], 1), dtype=np.int32)], 1)
-        self.policy_mask_pad = torch.from_numpy(policy_mask_pad).long()
-        action_state_pad = np.concatenate([action_state, np.expand_dims(np.arange(action_state.shape[0]), 1)], 1)
-        self.action_state_pad = torch.from_numpy(action_state_pad).long()
-        
-        self.path_feature = torch.from_numpy(path_feature).float()
-        self.link_feature = torch.from_numpy(link_feature).float()
-        self.new_index = torch.tensor([7, 0, 1, 6, 8, 2, 5, 4, 3]).long()
+        # policy mask, neighbour layout, path / link features and speed table, see FeatureTables
+        self.feature_builder = feature_builder if feature_builder is not None else \
+            FeatureBuilder(policy_mask, action_state, path_feature, link_feature, speed_feature)
       
         self.pad_idx = pad_idx
         self.action_num = action_num
@@ -36,48 +28,8 @@ class PolicyCNN(nn.Module):
         # Increase the input dimension by 1 to account for the weather feature
         self.conv1 = nn.Conv2d(input_dim + 1, 20, 3, padding=1)
 
-    def to_device(self, device):
-        self.policy_mask = self.policy_mask.to(device)
-        self.policy_mask_pad = self.policy_mask_pad.to(device)
-        self.action_state_pad = self.action_state_pad.to(device)
-        self.path_feature = self.path_feature.to(device)
-        self.link_feature = self.link_feature.to(device)
-        self.new_index = self.new_index.to(device)
-
-    def process_features(self, state, des, time_step):
-
-        # self.action_state_pad = self.action_state_pad.to(state.device)
-        state_neighbor = self.action_state_pad[state]
-        # print('state_neighbor', state_neighbor)
-        neigh_path_feature = self.path_feature[state_neighbor, des.unsqueeze(1).repeat(1, self.action_num + 1), :]
-        # print('neigh_path_feature',neigh_path_feature)
-        neigh_edge_feature = self.link_feature[state_neighbor, :]
-        # print('neigh_edge_feature',neigh_edge_feature)
-        neigh_mask_feature = self.policy_mask_pad[state].unsqueeze(-1)  # [batch_size, 9, 1]
-
-        # Get speed features
-        speed_features = []
-        for i in range(state.size(0)):
-            speed_row = []
-            for neighbor in state_neighbor[i]:
-                speed = self.speed_data.get((neighbor.item(), time_step[i].item()), 0)  # Default to 0 if not found
-                speed_row.append(speed)
-            speed_features.append(speed_row)
-        speed_feature = torch.tensor(speed_features, dtype=torch.float32, device=state.device).unsqueeze(-1)
-        
-        # print('speed_feature',speed_feature)
-        # weather_feature = neigh_path_feature[:, :, 0].unsqueeze(-1).float()
-        neigh_feature = torch.cat([speed_feature, neigh_path_feature, neigh_edge_feature, neigh_mask_feature], -1)
-
-        # neigh_feature = torch.cat([neigh_path_feature, neigh_edge_feature, neigh_mask_feature], -1)
-        neigh_feature = neigh_feature[:, self.new_index, :]
-        # print('neigh_feature',neigh_feature)
-        
-        # print('block',block)
-        x = neigh_feature.view(state.size(0), 3, 3, -1)
-       
-        x = x.permute(0, 3, 1, 2)
-        return x
+    def process_features(self, state, des, time_step, reuse_buffer=False):
+        return self.neigh_layout.features(state, des, time_step, self.path_feature, self.speed_feature, reuse_buffer)
 
     def forward(self, x):
         x = self.pool(F.leaky_relu(self.conv1(x), 0.2))
@@ -88,12 +40,25 @@ class PolicyCNN(nn.Module):
         x = self.fc3(x)
         return x
 
-    def get_action_prob(self, state, des, time_step):
-        x = self.process_features(state, des, time_step)
+    def masked_logits(self, x, x_mask):
         x = self.forward(x)
+        return x.masked_fill((1 - x_mask).bool(), -1e32)
+
+    def get_action_prob(self, state, des, time_step):
+        # without autograd nothing keeps the input, so it is written into the layout's buffer
+        x = self.process_features(state, des, time_step, reuse_buffer=not torch.is_grad_enabled())
         x_mask = self.policy_mask[state]  # [batch, 8]
-        x = x.masked_fill((1 - x_mask).bool(), -1e32)
-        return F.softmax(x, dim=1)
+        return F.softmax(self.masked_logits(x, x_mask), dim=1)
+
+    def get_log_prob_features(self, features, actions, index=None):
+        """
+        get_log_prob on the BatchFeatures of model.features.FeatureBuilder; with index the features are those of
+        distinct triples (UniqueFeatures) and row i of the batch is row index[i] of them
+        """
+        action_prob = F.softmax(self.masked_logits(features.neigh, features.mask), dim=1)
+        if index is not None:
+            action_prob = action_prob[index]
+        return torch.log(action_prob.gather(1, actions.long().unsqueeze(1)))
 
     def get_action_log_prob(self, state, des, time_step):
         x = self.process_features(state, des, time_step)
@@ -122,3 +87,61 @@ class PolicyCNN(nn.Module):
         action_prob = self.get_action_prob(state, des, time_step)
         M = action_prob.pow(-1).view(-1).detach()
         return M, action_prob, {}
+
+
+class PolicyInference(nn.Module):
+    """
+    process_features + forward + masking + softmax of a PolicyCNN in one scriptable module, see script_policy.
+    The layers are the policy's own, so optimizer steps and load_state_dict on the policy are seen here;
+    the feature tables are non-persistent buffers (the dense path features of a PathFeatureStore and the
+    precomputed NeighbourLayout tables).
+    """
+
+    def __init__(self, policy):
+        super(PolicyInference, self).__init__()
+        self.conv1, self.pool, self.conv2 = policy.conv1, policy.pool, policy.conv2
+        self.fc1, self.fc2, self.fc3 = policy.fc1, policy.fc2, policy.fc3
+        self.n_link = policy.path_feature.n_link
+        self.register_buffer('path_feature', policy.path_feature.feature, persistent=False)
+        self.register_buffer('speed_feature', policy.speed_feature, persistent=False)
+        self.register_buffer('policy_mask', policy.policy_mask, persistent=False)
+        self.register_buffer('neighbor', policy.neigh_layout.neighbor, persistent=False)
+        self.register_buffer('static', policy.neigh_layout.static, persistent=False)
+
+    def forward(self, state, des, time_step):
+        # NeighbourLayout.features on the dense path features of a PathFeatureStore
+        neighbor = self.neighbor[state]
+        des_neighbor = des.unsqueeze(1).expand_as(neighbor)
+        valid = (neighbor < self.n_link) & (des_neighbor < self.n_link)
+        path = self.path_feature[neighbor.clamp(max=self.n_link - 1), des_neighbor.clamp(max=self.n_link - 1)]
+        path = path.masked_fill(~valid.unsqueeze(-1), 0.)
+        speed = gather_speed(self.speed_feature, neighbor, time_step.unsqueeze(1)).unsqueeze(-1)
+        x = torch.cat([speed, path, self.static[state]], -1).view(state.size(0), 3, 3, -1).permute(0, 3, 1, 2)
+
+        x = self.pool(F.leaky_relu(self.conv1(x), 0.2))
+        x = F.leaky_relu(self.conv2(x), 0.2)
+        x = x.view(-1, 30)
+        x = F.leaky_relu(self.fc1(x), 0.2)
+        x = F.leaky_relu(self.fc2(x), 0.2)
+        x = self.fc3(x)
+        x = x.masked_fill(self.policy_mask[state] == 0, -1e32)
+        return F.softmax(x, dim=1)
+
+    @torch.jit.export
+    def get_action_prob(self, state, des, time_step):
+        return self.forward(state, des, time_step)
+
+    @torch.jit.export
+    def select_action(self, state, des, time_step):
+        # the draw of torch.distributions.Categorical(action_prob).sample()
+        return torch.multinomial(self.forward(state, des, time_step), 1, True).squeeze(1)
+
+
+def script_policy(policy):
+    """
+    TorchScript inference module of a PolicyCNN for rollouts and evaluation (get_action_prob / select_action only);
+    the eager policy is returned when its path features are computed per destination (PathFeatureProvider)
+    """
+    if not isinstance(policy.path_feature, PathFeatureStore):
+        return policy
+    return torch.jit.script(PolicyInference(policy))
@@ -1,9 +1,11 @@
+import os
+import hashlib
 from collections import namedtuple
 import torch
 import numpy as np
 import pandas as pd
 
-Step = namedtuple('Step', ['cur_state', 'action', 'next_state', 'reward', 'done'])
+Step = namedtuple('Step', ['cur_state', 'action', 'next_state', 'reward', 'done', 'time_step'])
 
 
 class RoadWorld(object):
@@ -12,31 +14,21 @@ class RoadWorld(object):
     """
 
     def __init__(self, network_path, edge_path, pre_reset=None, origins=None,
-                 destinations=None, k=8):
-        self.network_path = network_path
+                 destinations=None, k=8, training_data_path='../data/speed/formatted_data_w_timestep.csv',
+                 transitions=None):
+        self.network_path = os.path.abspath(network_path)
         self.netin = origins
         self.netout = destinations
         self.k = k
         self.max_route_length = 0
 
-        # Load the training data to find valid time steps for each origin-destination pair
-        training_data_path = '../data/speed/formatted_data_w_timestep.csv'
-        self.training_data = pd.read_csv(training_data_path)
-        self.od_time_map = self.training_data.groupby(['ori', 'des'])['time_step'].unique().to_dict()
-
-        # define transition matrix
-        netconfig = np.load(self.network_path)
-        netconfig = pd.DataFrame(netconfig, columns=["from", "con", "to"])
-        netconfig_dict = {}
-        for i in range(len(netconfig)):
-            fromid, con, toid = netconfig.loc[i]
-
-            if fromid in netconfig_dict.keys():
-                netconfig_dict[fromid][con] = toid
-            else:
-                netconfig_dict[fromid] = {}
-                netconfig_dict[fromid][con] = toid
-        self.netconfig = netconfig_dict
+        # the training data gives the valid time steps of each origin-destination pair, loaded on first use
+        self.training_data_path = os.path.abspath(training_data_path)  # read lazily, possibly from another cwd
+        self._training_data = None
+        self._od_time_map = None
+        self._most_common_time_step = None
+        self._od_sampler = None
+        self._netconfig = None
 
         # define states and actions
         edge_df = pd.read_csv(edge_path, header=0, usecols=['n_id'])
@@ -49,26 +41,23 @@ class RoadWorld(object):
 
         self.n_states = len(self.states)
         self.n_actions = len(self.actions)
-        # print('n_states', self.n_states)
-        # print('n_actions', self.n_actions)
 
         self.rewards = [0 for _ in range(self.n_states)]
 
-        self.state_action_pair = sum([[(s, a) for a in self.get_action_list(s)] for s in self.states], [])
+        # define transition matrix: CSR arrays, the transitions of state s are indptr[s]:indptr[s + 1]
+        # (given as transitions when they come from a compiled dataset bundle)
+        if transitions is None:
+            transitions = self.load_transitions(self.network_path)
+        self.indptr, self.indices, self.action_ids = transitions
+        action_src = np.repeat(np.arange(self.n_states), np.diff(self.indptr))
+        self.state_action_pair = list(zip(action_src.tolist(), self.action_ids.tolist()))
         self.num_sapair = len(self.state_action_pair)
-        # print('n_sapair', self.num_sapair)
 
         self.sapair_idxs = self.state_action_pair  # I think in our case this two should be the same
         self.policy_mask = np.zeros([self.n_states, self.n_actions], dtype=np.int32)
         self.state_action = np.ones([self.n_states, self.n_actions], dtype=np.int32) * self.pad_idx
-        # print('policy mask', self.policy_mask.shape)
-        for s, a in self.sapair_idxs:
-            s = int(s)  # Convert to integer
-            a = int(a)  # Convert to integer
-            self.policy_mask[s, a] = 1
-            self.state_action[s, a] = self.netconfig[s][a]
-            # self.policy_mask[s, a] = 1
-            # self.state_action[s, a] = self.netconfig[s][a]
+        self.policy_mask[action_src, self.action_ids] = 1
+        self.state_action[action_src, self.action_ids] = self.indices
 
         self.cur_state = None
         self.cur_des = None
@@ -78,24 +67,132 @@ class RoadWorld(object):
             self.od_list = pre_reset[0]
             self.od_dist = pre_reset[1]
 
+    def load_transitions(self, network_path):
+        """
+        CSR transitions (indptr, indices, action_ids) of the [from, con, to] transit array, one row per state;
+        as with a {from: {con: to}} dict, a repeated (from, con) keeps the position of its first occurrence
+        and the target of its last one
+        """
+        netconfig = np.load(network_path).astype(np.int64)
+        netconfig = netconfig[(netconfig[:, 0] >= 0) & (netconfig[:, 0] < self.n_states)]
+        key = netconfig[:, 0] * self.n_actions + netconfig[:, 1]
+        _, first = np.unique(key, return_index=True)
+        _, last = np.unique(key[::-1], return_index=True)
+        last = len(key) - 1 - last
+        order = np.lexsort((first, netconfig[first, 0]))
+        first, last = first[order], last[order]
+        indptr = np.zeros(self.n_states + 1, dtype=np.int64)
+        np.cumsum(np.bincount(netconfig[first, 0], minlength=self.n_states), out=indptr[1:])
+        return indptr, netconfig[last, 2], netconfig[first, 1]
+
+    @property
+    def netconfig(self):
+        """{from: {con: to}} view of the transitions, built on first use"""
+        if self._netconfig is None:
+            self._netconfig = {}
+            for s in np.flatnonzero(np.diff(self.indptr)).tolist():
+                start, end = self.indptr[s], self.indptr[s + 1]
+                self._netconfig[s] = dict(zip(self.action_ids[start:end].tolist(), self.indices[start:end].tolist()))
+        return self._netconfig
+
+    @property
+    def training_data(self):
+        if self._training_data is None:
+            self._training_data = pd.read_csv(self.training_data_path)
+        return self._training_data
+
+    def load_od_time(self):
+        """
+        time steps seen for every od pair and the most common time step of the training data,
+        cached in <training_data_path>.od_time.npz
+        """
+        cache_path = self.training_data_path + '.od_time.npz'
+        cache = None
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(self.training_data_path):
+            cache = np.load(cache_path)
+            if 'most_common' not in cache.files:
+                cache = None
+        if cache is not None:
+            od, indptr, time_step = cache['od'], cache['indptr'], cache['time_step']
+            most_common = cache['most_common']
+        else:
+            od_time = pd.read_csv(self.training_data_path, usecols=['ori', 'des', 'time_step'])
+            # same value as time_step.mode()[0]: the smallest of the most frequent time steps
+            values, count = np.unique(od_time['time_step'].dropna().values.astype(np.int64), return_counts=True)
+            most_common = values[np.argmax(count)] if len(values) > 0 else np.int64(-1)
+            od_time = od_time.drop_duplicates().sort_values(['ori', 'des'], kind='stable')
+            od, count = np.unique(od_time[['ori', 'des']].values.astype(np.int64), axis=0, return_counts=True)
+            indptr = np.concatenate([[0], np.cumsum(count)])
+            time_step = od_time['time_step'].values.astype(np.int64)
+            np.savez(cache_path, od=od, indptr=indptr, time_step=time_step, most_common=most_common)
+        self._od_time_map = {(ori, des): time_step[indptr[i]:indptr[i + 1]]
+                             for i, (ori, des) in enumerate(od.tolist())}
+        self._most_common_time_step = int(most_common) if most_common >= 0 else None
+
+    @property
+    def od_time_map(self):
+        """{(ori, des): array of the time steps seen for the pair}"""
+        if self._od_time_map is None:
+            self.load_od_time()
+        return self._od_time_map
+
+    @property
+    def most_common_time_step(self):
+        if self._od_time_map is None:
+            self.load_od_time()
+        return self._most_common_time_step
+
+    def build_od_sampler(self):
+        """
+        alias table over od_dist, so drawing an od is O(1), and the time steps of every od of od_list as CSR
+        arrays; an od without time steps gets the most common one
+        """
+        od = np.array([od.split('_') for od in self.od_list], dtype=np.int64).reshape(-1, 2)
+        prob = np.asarray(self.od_dist, dtype=np.float64)
+        scaled = prob * len(prob) / prob.sum()
+        accept = np.ones(len(prob))
+        alias = np.arange(len(prob))
+        small, large = np.flatnonzero(scaled < 1).tolist(), np.flatnonzero(scaled >= 1).tolist()
+        while small and large:
+            s, l = small.pop(), large.pop()
+            accept[s], alias[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+
+        default = self.most_common_time_step
+        empty = np.empty(0, dtype=np.int64)
+        time_steps = [self.od_time_map.get((ori, des), empty) for ori, des in od.tolist()]
+        count = np.array([len(t) for t in time_steps], dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(count)])
+        # the default time step sits past the last od, empty ods point there
+        values = np.concatenate(time_steps + [np.array([-1 if default is None else default])]).astype(np.int64)
+        self._od_sampler = {'od': od, 'accept': accept, 'alias': alias, 'indptr': indptr, 'count': count,
+                            'time_step': values}
+
+    def sample_od(self, n):
+        """draw n (ori, des, time_step) triples following od_dist and the time steps seen for each od"""
+        if self._od_sampler is None:
+            self.build_od_sampler()
+        sampler = self._od_sampler
+        i = np.random.randint(len(sampler['accept']), size=n)
+        i = np.where(np.random.random_sample(n) < sampler['accept'][i], i, sampler['alias'][i])
+        count = sampler['count'][i]
+        pick = sampler['indptr'][i] + (np.random.random_sample(n) * count).astype(np.int64)
+        time_step = sampler['time_step'][np.where(count > 0, pick, len(sampler['time_step']) - 1)]
+        return sampler['od'][i, 0], sampler['od'][i, 1], time_step
+
     def reset(self, st=None, des=None, time_step=None): # timestep
         if st is not None and des is not None:
             self.cur_state, self.cur_des = st, des
-            self.cur_time_step = time_step if time_step is not None else self.get_most_common_time_step()
+            self.cur_time_step = time_step if time_step is not None else self.most_common_time_step
         else:
-            od_idx = np.random.choice(self.od_list, 1, p=self.od_dist)
-            ori, des = od_idx[0].split('_')
-            self.cur_state, self.cur_des = int(ori), int(des)
-            valid_time_steps = self.od_time_map.get((self.cur_state, self.cur_des), [])
-            if valid_time_steps.size > 0:
-                self.cur_time_step = np.random.choice(valid_time_steps)  # Choose a valid time step randomly
-            else:
-                self.cur_time_step = self.get_most_common_time_step()  # Use the most common time step as default
+            # a valid time step of the od, or the most common time step if it has none
+            ori, des, time_step = self.sample_od(1)
+            self.cur_state, self.cur_des, self.cur_time_step = int(ori[0]), int(des[0]), int(time_step[0])
         return self.cur_state, self.cur_des, self.cur_time_step
-    
+
     def get_most_common_time_step(self):
-        # This method calculates the most common time step from the training data
-        return self.training_data['time_step'].mode()[0] if not self.training_data['time_step'].mode().empty else None
+        return self.most_common_time_step
 
     def get_reward(self, state):
         return self.rewards[int(state)]
@@ -112,9 +209,8 @@ class RoadWorld(object):
           reward        reward on the next state
           is_done       True/False - if the agent is already on the terminal states
         """
-        tmp_dict = self.netconfig.get(self.cur_state, None)
-        if tmp_dict is not None:
-            next_state = tmp_dict.get(action, self.pad_idx)
+        if 0 <= self.cur_state < self.n_states and 0 <= action < self.n_actions:
+            next_state = int(self.state_action[self.cur_state, action])
         else:
             next_state = self.pad_idx
         reward = self.get_reward(self.cur_state)
@@ -126,65 +222,120 @@ class RoadWorld(object):
         return self.netconfig[state][action]
 
     def get_action_list(self, state):
-        if state in self.netconfig.keys():
-            return list(self.netconfig[state].keys())
+        if 0 <= state < self.n_states:
+            return self.action_ids[self.indptr[state]:self.indptr[state + 1]].tolist()
         else:
             return list()
 
+    def action_lookup(self):
+        """sorted (from * n_states + to) keys and their actions, for finding the action of a hop with searchsorted"""
+        src = np.repeat(np.arange(self.n_states), np.diff(self.indptr))
+        keys = src * self.n_states + self.indices
+        # stable: of several actions reaching the same link, the first in get_action_list order wins
+        order = np.argsort(keys, kind='stable')
+        return keys[order], self.action_ids[order]
+
+    def load_demonstrations(self, demopath, n_rows=None):
+        """
+        hop arrays (state, des, action, next_state, time_step) of the demonstrations plus the number of hops of
+        every trajectory, cached in <demopath>.demo.npz under a hash of the csv, the transit file and n_rows
+        """
+        digest = hashlib.sha1()
+        for path in (demopath, self.network_path):
+            with open(path, 'rb') as fin:
+                digest.update(fin.read())
+        digest.update(str(n_rows).encode())
+        key = digest.hexdigest()
+        cache_path = demopath + '.demo.npz'
+        if os.path.exists(cache_path):
+            cache = np.load(cache_path)
+            if str(cache['key']) == key:
+                return {name: cache[name] for name in cache.files if name != 'key'}
+
+        demo = pd.read_csv(demopath, header=0, nrows=n_rows, usecols=['path', 'des', 'time_step'])
+        paths = demo['path'].astype(str)
+        path_len = paths.str.count('_').values + 1
+        links = np.array('_'.join(paths.tolist()).split('_'), dtype=np.int64) if len(demo) > 0 \
+            else np.empty(0, dtype=np.int64)
+        # a hop starts at every link but the last one of its path
+        is_last = np.zeros(len(links), dtype=bool)
+        is_last[np.cumsum(path_len) - 1] = True
+        hop = np.flatnonzero(~is_last)
+        cur_state, next_state = links[hop], links[hop + 1]
+        traj_len = path_len - 1
+
+        keys, actions = self.action_lookup()
+        query = cur_state * self.n_states + next_state
+        pos = np.searchsorted(keys, query)
+        found = pos < len(keys)
+        found[found] = keys[pos[found]] == query[found]
+        if not found.all():
+            k = np.flatnonzero(~found)[0]
+            raise ValueError('no action leads from link %d to link %d' % (cur_state[k], next_state[k]))
+
+        demos = {'state': cur_state, 'des': np.repeat(demo['des'].values.astype(np.int64), traj_len),
+                 'action': actions[pos], 'next_state': next_state,
+                 'time_step': np.repeat(demo['time_step'].values.astype(np.int64), traj_len), 'traj_len': traj_len}
+        np.savez(cache_path, key=np.array(key), **demos)
+        return demos
+
     def import_demonstrations(self, demopath, od=None, n_rows=None):
-        demo = pd.read_csv(demopath, header=0, nrows=n_rows)
-        expert_st, expert_des, expert_ac, expert_st_next, expert_time_step = [], [], [], [], []
-        for demo_str, demo_des, demo_time_step in zip(demo['path'].tolist(), demo['des'].tolist(), demo['time_step'].tolist()):
-            cur_demo = [int(r) for r in demo_str.split('_')]
-            len_demo = len(cur_demo)
-            for i0 in range(1, len_demo):
-                cur_state = cur_demo[i0 - 1]
-                next_state = cur_demo[i0]
-                action_list = self.get_action_list(cur_state)
-                # print('cur_state',cur_state)
-                # print('action_list',action_list)
-                # print('next_state',next_state)
-                j = [self.get_state_transition(cur_state, a0) for a0 in action_list].index(next_state)
-                action = action_list[j]
-                expert_st.append(cur_state)
-                expert_des.append(demo_des)
-                expert_ac.append(action)
-                expert_st_next.append(next_state)
-                expert_time_step.append(demo_time_step)
-        return torch.LongTensor(expert_st), torch.LongTensor(expert_des), torch.LongTensor(expert_ac), torch.LongTensor(
-            expert_st_next), torch.LongTensor(expert_time_step)
+        demos = self.load_demonstrations(demopath, n_rows)
+        return tuple(torch.from_numpy(demos[name]) for name in ['state', 'des', 'action', 'next_state', 'time_step'])
 
     def import_demonstrations_step(self, demopath, n_rows=None):
-        demo = pd.read_csv(demopath, header=0, nrows=n_rows)
+        demos = self.load_demonstrations(demopath, n_rows)
+        rewards = np.asarray(self.rewards)[demos['state']].tolist()
+        done = (demos['next_state'] == demos['des']).tolist()
+        hops = list(zip(demos['state'].tolist(), demos['action'].tolist(), demos['next_state'].tolist(),
+                        rewards, done, demos['time_step'].tolist()))
         trajs = []
-        for demo_str, demo_des, demo_time_step in zip(demo['path'].tolist(), demo['des'].tolist(), demo['time_step'].tolist()):
-            cur_demo = [int(r) for r in demo_str.split('_')]
-            len_demo = len(cur_demo)
-            episode = []
-            for i0 in range(1, len_demo):
-                cur_state = cur_demo[i0 - 1]
-                next_state = cur_demo[i0]
-                # print('cur_state',cur_state)
-                # print('next_state',next_state)
-
-                action_list = self.get_action_list(cur_state)
-                
-                # for a0 in action_list:
-                #     print('a0',a0)
-                #     print('cur_state',cur_state)
-                #     print('self.get_state_transition(cur_state, a0)',self.get_state_transition(cur_state, a0))
-                #     print('next stat',next_state)
-
-                j = [self.get_state_transition(cur_state, a0) for a0 in action_list].index(next_state)
-                action = action_list[j]
-
-                reward = self.get_reward(cur_state)
-                is_done = next_state == demo_des
-
-                episode.append(
-                    Step(cur_state=cur_state, action=action, next_state=next_state, reward=reward, done=is_done, time_step=demo_time_step))
-            trajs.append(episode)
-            self.max_route_length = len(episode) if self.max_route_length < len(episode) else self.max_route_length
+        start = 0
+        for traj_len in demos['traj_len'].tolist():
+            trajs.append([Step(*hop) for hop in hops[start:start + traj_len]])
+            start += traj_len
+        if len(trajs) > 0:
+            self.max_route_length = max(self.max_route_length, int(demos['traj_len'].max()))
         print('max_route_length', self.max_route_length)
         print('n_traj', len(trajs))
-        return trajs
\ No newline at end of file
+        return trajs
+
+class BatchedRoadWorld(object):
+    """
+    Vectorized environment advancing n_envs episodes of a RoadWorld in lockstep
+    """
+
+    def __init__(self, env, n_envs):
+        self.env = env
+        self.n_envs = n_envs
+        self.pad_idx = env.pad_idx
+        self.state_action = env.state_action
+        self.rewards = np.asarray(env.rewards, dtype=np.float32)
+
+        self.cur_state = np.full(n_envs, self.pad_idx, dtype=np.int64)
+        self.cur_des = np.full(n_envs, self.pad_idx, dtype=np.int64)
+        self.cur_time_step = np.zeros(n_envs, dtype=np.int64)
+        self.t = np.zeros(n_envs, dtype=np.int64)  # number of steps taken in the current episode
+
+    def reset(self, idx=None):
+        """start new episodes in the given slots (all slots by default) using the underlying env sampler"""
+        idx = np.arange(self.n_envs) if idx is None else np.asarray(idx, dtype=np.int64)
+        self.cur_state[idx], self.cur_des[idx], self.cur_time_step[idx] = self.env.sample_od(len(idx))
+        self.t[idx] = 0
+        return self.cur_state[idx], self.cur_des[idx], self.cur_time_step[idx]
+
+    def step(self, idx, action):
+        """
+        Step the episodes in slots idx with one action each
+        returns
+          next_state    next_state of every stepped episode
+          reward        reward on the current state
+          is_done       True/False - if the episode reached its destination or the pad state
+        """
+        cur_state = self.cur_state[idx]
+        next_state = self.state_action[cur_state, action].astype(np.int64)
+        reward = self.rewards[cur_state]
+        self.cur_state[idx] = next_state
+        self.t[idx] += 1
+        done = (next_state == self.cur_des[idx]) | (next_state == self.pad_idx)
+        return next_state, reward, done
@@ -1,82 +1,131 @@
-from utils.evaluation import evaluate_model, evaluate_log_prob, evaluate_train_edit_dist
-import time
+import csv
 import torch
-from utils.load_data import ini_od_dist, load_path_feature, load_link_feature, \
-    minmax_normalization, load_train_sample, load_test_traj
-from network_env import RoadWorld
-from utils.torch import to_device
 import numpy as np
-import pandas as pd
 from model.policy import PolicyCNN
 from model.value import ValueCNN
 from model.discriminator import DiscriminatorAIRLCNN
-import csv
-import shap
-import matplotlib.pyplot as plt
-
-def load_model(model_path):
-    model_dict = torch.load(model_path)
-    policy_net.load_state_dict(model_dict['Policy'])
-    print("Policy Model loaded Successfully")
-    value_net.load_state_dict(model_dict['Value'])
-    print("Value Model loaded Successfully")
-    discrim_net.load_state_dict(model_dict['Discrim'])
-    print("Discrim Model loaded Successfully")
-
-cv = 0  # cross validation process [0, 1, 2, 3, 4]
-size = 10000  # size of training data [100, 1000, 10000]
-gamma = 0.99  # discount factor
-device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-
-model_p = "../trained_models/airl_CV%d_size%d.pt" % (cv, size)
-test_p = "../data/cross_validation/test_CV%d.csv" % cv
-
-"""environment"""
-edge_p = "../data/edge.txt"
-network_p = "../data/transit.npy"
-path_feature_p = "../data/feature_od.npy"
-train_p = "../data/cross_validation/train_CV%d_size%d.csv" % (cv, size)
-test_p = "../data/cross_validation/test_CV%d.csv" % cv
-model_p = "../trained_models/airl_CV%d_size%d.pt" % (cv, size)
-
-"""initialize road environment"""
-od_list, od_dist = ini_od_dist(train_p)
-env = RoadWorld(network_p, edge_p, pre_reset=(od_list, od_dist))
-"""load path-level and link-level feature"""
-path_feature, path_max, path_min = load_path_feature(path_feature_p)
-edge_feature, link_max, link_min = load_link_feature(edge_p)
-path_feature = minmax_normalization(path_feature, path_max, path_min)
-path_feature_pad = np.zeros((env.n_states, env.n_states, path_feature.shape[2]))
-path_feature_pad[:path_feature.shape[0], :path_feature.shape[1], :] = path_feature
-edge_feature = minmax_normalization(edge_feature, link_max, link_min)
-edge_feature_pad = np.zeros((env.n_states, edge_feature.shape[1]))
-edge_feature_pad[:edge_feature.shape[0], :] = edge_feature
-
-"""define actor and critic"""
-edge_data = pd.read_csv('../data/updated_edges.txt')
-speed_data = {(row['n_id'], row['time_step']): row['speed'] for _, row in edge_data.iterrows()}
-
-policy_net = PolicyCNN(env.n_actions, env.policy_mask, env.state_action,
-                    path_feature_pad, edge_feature_pad,
-                    path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
-                    env.pad_idx, speed_data).to(device)
-value_net = ValueCNN(path_feature_pad, edge_feature_pad,
-                    path_feature_pad.shape[-1] + edge_feature_pad.shape[-1], speed_data=speed_data).to(device)
-discrim_net = DiscriminatorAIRLCNN(env.n_actions, gamma, env.policy_mask,
-                                env.state_action, path_feature_pad, edge_feature_pad,
-                                path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
-                                path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],
-                                env.pad_idx, speed_data).to(device)
-
-# Read the transit data from the CSV file
-transit_data = pd.read_csv('../data/transit.csv')
-
-# Create a dictionary to map (link_id, next_link_id) to action
-transit_dict = {}
-for _, row in transit_data.iterrows():
-    transit_dict[(row['link_id'], row['next_link_id'])] = row['action']
+from model.features import FeatureBuilder
+
+
+class Explainer(object):
+    """
+    Discriminator rewards along recorded trajectories and their SHAP explanation.
+    The environment, the networks and the transit table are loaded by setup() on first use;
+    shap and matplotlib are imported only when the explanation is computed.
+    """
+
+    def __init__(self, cv=0, size=10000, device=None):
+        self.cv = cv  # cross validation process [0, 1, 2, 3, 4]
+        self.size = size  # size of training data [100, 1000, 10000]
+        self.gamma = 0.99  # discount factor
+        if device is None:
+            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
+
+        """environment"""
+        self.edge_p = "../data/edge.txt"
+        self.network_p = "../data/transit.npy"
+        self.path_feature_p = "../data/feature_od.npy"
+        self.train_p = "../data/cross_validation/train_CV%d_size%d.csv" % (cv, size)
+        self.test_p = "../data/cross_validation/test_CV%d.csv" % cv
+        self.model_p = "../trained_models/airl_CV%d_size%d.pt" % (cv, size)
+        self.speed_p = "../data/updated_edges.txt"
+        self.transit_p = "../data/transit.csv"
+        self.bundle_p = "../data/bundle/CV%d_size%d" % (cv, size)
+        self.env = None
+
+    def setup(self):
+        if self.env is not None:
+            return
+        import pandas as pd
+        from utils.dataset_bundle import load_dataset_bundle
+        device = self.device
+        """initialize road environment"""
+        bundle = load_dataset_bundle(self.bundle_p, self.edge_p, self.network_p, self.speed_p, self.train_p,
+                                     self.path_feature_p)
+        env = bundle.road_world(self.network_p, self.edge_p)
+        """load path-level and link-level feature"""
+        path_feature_pad = bundle.path_feature
+        edge_feature_pad = bundle.edge_feature
+
+        """define actor and critic"""
+        speed_feature = bundle.speed_feature
+        feature_builder = FeatureBuilder(env.policy_mask, env.state_action, path_feature_pad, edge_feature_pad,
+                                         speed_feature)
+
+        self.policy_net = PolicyCNN(env.n_actions, env.policy_mask, env.state_action,
+                                    path_feature_pad, edge_feature_pad,
+                                    path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
+                                    env.pad_idx, speed_feature, feature_builder).to(device)
+        self.value_net = ValueCNN(path_feature_pad, edge_feature_pad,
+                                  path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],
+                                  speed_feature=speed_feature, feature_builder=feature_builder).to(device)
+        self.discrim_net = DiscriminatorAIRLCNN(env.n_actions, self.gamma, env.policy_mask,
+                                                env.state_action, path_feature_pad, edge_feature_pad,
+                                                path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1,
+                                                path_feature_pad.shape[-1] + edge_feature_pad.shape[-1],
+                                                env.pad_idx, speed_feature, feature_builder).to(device)
+
+        # Read the transit data from the CSV file
+        self.transit_data = pd.read_csv(self.transit_p)
+
+        # Create a dictionary to map (link_id, next_link_id) to action
+        self.transit_dict = dict(zip(zip(self.transit_data['link_id'].tolist(),
+                                         self.transit_data['next_link_id'].tolist()),
+                                     self.transit_data['action'].tolist()))
+        self.env = env
+
+    def load_model(self, model_path):
+        self.setup()
+        model_dict = torch.load(model_path)
+        self.policy_net.load_state_dict(model_dict['Policy'])
+        print("Policy Model loaded Successfully")
+        self.value_net.load_state_dict(model_dict['Value'])
+        print("Value Model loaded Successfully")
+        self.discrim_net.load_state_dict(model_dict['Discrim'])
+        print("Discrim Model loaded Successfully")
+
+    def explain(self, trajectory_path='trajectory_with_timestep.csv', num_explained=10):
+        """rewards of the test trajectories of trajectory_path, SHAP values of the first num_explained steps"""
+        self.setup()
+        trajectory_data = read_trajectory_data(trajectory_path)
+
+        # Extract test and learner trajectories and their timesteps
+        test_traj = [row[0] for row in trajectory_data]
+        test_time_steps = [row[1] for row in trajectory_data]
+
+        # Evaluate rewards
+        reward_df, input_features, output_rewards = evaluate_rewards(test_traj, test_time_steps, self.policy_net,
+                                                                     self.discrim_net, self.env, self.transit_dict,
+                                                                     self.transit_data)
+        print('input_features length:', len(input_features))
+
+        # Create SHAP explainer
+        explainer = create_shap_explainer(self.discrim_net, input_features)
+
+        # Example usage:
+        selected_feature_indices = [
+            189, 190, 191, 192, 193, 194, 195, 196, 197,  # Speed features
+            198, 199, 200, 201, 202, 203, 204, 205, 206, 207, 208, 209,  # Path features
+            211, 212, 213, 214, 215, 216, 217  # Edge features
+        ]
+
+        # Analyze SHAP values
+        analyze_shap_values(explainer, input_features[:num_explained], selected_feature_indices)
+
+
+def read_trajectory_data(trajectory_path):
+    # Read the trajectory data from the CSV file
+    trajectory_data = []
+    with open(trajectory_path, 'r') as csvfile:
+        csv_reader = csv.reader(csvfile)
+        next(csv_reader)  # Skip the header row
+        for row in csv_reader:
+            trajectory_data.append(row)
+    return trajectory_data
 
 def evaluate_rewards(traj_data, time_steps, policy_net, discrim_net, env, transit_dict, transit_data):
+    import pandas as pd
     device = torch.device('cpu')  # Use CPU device
     policy_net.to(device)
     discrim_net.to(device)
@@ -143,6 +192,7 @@ def evaluate_rewards(traj_data, time_steps, policy_net, discrim_net, env, transi
     return reward_df, input_features, output_rewards
 
 def create_shap_explainer(model, input_features):
+    import shap
     # Convert input_features from list of dictionaries to a 2D numpy array
     feature_keys = ['speed_feature', 'neigh_path_feature', 'neigh_edge_feature', 'path_feature', 'edge_feature', 'next_path_feature', 'next_edge_feature', 'action', 'log_prob', 'time_step']
     
@@ -214,6 +264,9 @@ def create_shap_explainer(model, input_features):
     return explainer
 
 def analyze_shap_values(explainer, input_features, feature_indices):
+    import shap
+    import pandas as pd
+    import matplotlib.pyplot as plt
     # Convert input_features from list of dictionaries to a 2D numpy array
     feature_keys = ['speed_feature', 'neigh_path_feature', 'neigh_edge_feature', 'path_feature', 'edge_feature', 'next_path_feature', 'next_edge_feature', 'action', 'log_prob', 'time_step']
     
@@ -271,33 +324,6 @@ def analyze_shap_values(explainer, input_features, feature_indices):
     plt.close()
     print("Selected SHAP summary plot saved to 'selected_shap_summary_plot.png'")
 
-# Read the trajectory data from the CSV file
-trajectory_data = []
-with open('trajectory_with_timestep.csv', 'r') as csvfile:
-    csv_reader = csv.reader(csvfile)
-    next(csv_reader)  # Skip the header row
-    for row in csv_reader:
-        trajectory_data.append(row)
-
-# Extract test and learner trajectories and their timesteps
-test_traj = [row[0] for row in trajectory_data]
-test_time_steps = [row[1] for row in trajectory_data]
-learner_traj = [row[2] for row in trajectory_data]
-learner_time_steps = [row[3] for row in trajectory_data]
-
-# Evaluate rewards
-reward_df, input_features, output_rewards = evaluate_rewards(test_traj, test_time_steps, policy_net, discrim_net, env, transit_dict, transit_data)
-print('input_features length:', len(input_features))
-
-# Create SHAP explainer
-explainer = create_shap_explainer(discrim_net, input_features)
-
-# Example usage:
-selected_feature_indices = [
-    189, 190, 191, 192, 193, 194, 195, 196, 197,  # Speed features
-    198, 199, 200, 201, 202, 203, 204, 205, 206, 207, 208, 209,  # Path features
-    211, 212, 213, 214, 215, 216, 217  # Edge features
-]
-
-# Analyze SHAP values
-analyze_shap_values(explainer, input_features[:10], selected_feature_indices)
\ No newline at end of file
+
+if __name__ == '__main__':
+    Explainer(cv=0, size=10000).explain()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other relative to src, as the entry scripts run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+import pytest
+from network_env import RoadWorld
+from utils.evaluation import decode_greedy_routes
+from utils.policy_cache import PolicyTableCache
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'base')
+
+
+class TablePolicy(torch.nn.Module):
+    """masked softmax of random state, destination and time step logits; uniform gives tied probabilities"""
+
+    def __init__(self, env, n_time_steps, seed, uniform=False):
+        super(TablePolicy, self).__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.state_logit = torch.nn.Parameter(torch.randn(env.n_states, env.n_actions, generator=generator))
+        self.des_logit = torch.randn(env.n_states, env.n_actions, generator=generator)
+        self.time_logit = torch.randn(n_time_steps, env.n_actions, generator=generator)
+        self.policy_mask = torch.from_numpy(env.policy_mask).long()
+        self.uniform = uniform
+
+    def get_action_prob(self, state, des, time_step):
+        logit = self.state_logit[state] + self.des_logit[des] + self.time_logit[time_step]
+        if self.uniform:
+            logit = torch.zeros_like(logit)
+        return F.softmax(logit.masked_fill(self.policy_mask[state] == 0, -1e32), dim=1)
+
+
+def dense_argmax_routes(target_od, model, env, n_link):
+    """the decoder decode_greedy_routes replaced: argmax over a dense link x link transition matrix per row"""
+    state_ts = torch.arange(n_link)
+    state_action = env.state_action[:-1]
+    from_st, ac = np.where(state_action != env.pad_idx)
+    to_st = state_action[state_action != env.pad_idx]
+    routes = []
+    for ori, des, time_step in target_od.tolist():
+        with torch.no_grad():
+            action_prob = model.get_action_prob(state_ts, torch.full_like(state_ts, des),
+                                                torch.full_like(state_ts, time_step)).numpy()
+        action_prob[state_action == env.pad_idx] = 0.0
+        transit_prob = np.zeros((n_link, n_link))
+        transit_prob[from_st, to_st] = action_prob[from_st, ac]
+        path = [str(ori)]
+        state = ori
+        for _ in range(50):
+            if state == des:
+                break
+            state = np.argmax(transit_prob[state])
+            path.append(str(state))
+        routes.append(path)
+    return routes
+
+
+@pytest.fixture(scope='module')
+def env():
+    return RoadWorld(os.path.join(DATA, 'transit.npy'), os.path.join(DATA, 'edge.txt'))
+
+
+def random_od(env, n, n_time_steps, seed):
+    rng = np.random.RandomState(seed)
+    od = np.stack([rng.randint(0, env.pad_idx, n), rng.randint(0, env.pad_idx, n),
+                   rng.randint(0, n_time_steps, n)], 1)
+    od[:10, 1] = od[:10, 0]  # routes that start at their destination
+    od[10:20] = od[20]  # repeated rows of one group
+    return od
+
+
+@pytest.mark.parametrize('uniform', [False, True])
+def test_grouped_decoder_matches_dense_argmax(env, uniform):
+    model = TablePolicy(env, 4, 0, uniform)
+    target_od = random_od(env, 300, 4, 1)
+    expected = dense_argmax_routes(target_od, model, env, env.pad_idx)
+    assert decode_greedy_routes(target_od, model, env) == expected
+    assert decode_greedy_routes(torch.from_numpy(target_od), model, env) == expected
+    assert decode_greedy_routes(target_od.tolist(), model, env, cache=PolicyTableCache(model, env.n_states)) == expected
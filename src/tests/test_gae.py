@@ -0,0 +1,69 @@
+import torch
+import pytest
+from core.common import estimate_advantages
+
+
+def reference_gae(rewards, masks, bad_masks, values, next_values, gamma, tau):
+    """the backwards loop estimate_advantages replaced"""
+    advantages = torch.zeros(rewards.size(0), 1, dtype=torch.float64)
+    prev_advantage = 0
+    for i in reversed(range(rewards.size(0))):
+        delta = rewards[i] + gamma * next_values[i] - values[i]
+        advantages[i] = (delta + gamma * tau * prev_advantage * masks[i]) * bad_masks[i]
+        prev_advantage = advantages[i, 0]
+    returns = values + advantages
+    advantages = (advantages - advantages.mean()) / advantages.std()
+    return advantages, returns
+
+
+def random_batch(episode_lengths, seed):
+    """consecutive episodes; mask is 0 on the last step of every episode, bad_mask drops a few steps"""
+    generator = torch.Generator().manual_seed(seed)
+    n = sum(episode_lengths)
+    masks = torch.ones(n, dtype=torch.long)
+    masks[torch.tensor(episode_lengths).cumsum(0) - 1] = 0
+    bad_masks = (torch.rand(n, generator=generator) > 0.1).long()
+    rewards = torch.randn(n, generator=generator, dtype=torch.float64)
+    values = torch.randn(n, 1, generator=generator, dtype=torch.float64)
+    next_values = torch.randn(n, 1, generator=generator, dtype=torch.float64)
+    return rewards, masks, bad_masks, values, next_values
+
+
+@pytest.mark.parametrize('episode_lengths', [[7], [3, 1, 50, 2], [17] * 40, [1, 2, 3, 4, 5, 6, 7, 8, 130]])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_scan_matches_backwards_loop(episode_lengths, seed):
+    rewards, masks, bad_masks, values, next_values = random_batch(episode_lengths, seed)
+    advantages, returns = estimate_advantages(rewards, masks, bad_masks, values, next_values, 0.99, 0.95,
+                                              torch.device('cpu'))
+    ref_advantages, ref_returns = reference_gae(rewards.view(-1, 1), masks.view(-1, 1), bad_masks.view(-1, 1),
+                                                values, next_values, 0.99, 0.95)
+    assert torch.allclose(advantages, ref_advantages, atol=1e-10)
+    assert torch.allclose(returns, ref_returns, atol=1e-10)
+
+
+def test_episode_ending_on_last_row_does_not_leak():
+    # two episodes, the second ends on the last row: the first episode's advantages must not see the second's
+    rewards, masks, bad_masks, values, next_values = random_batch([5, 4], 3)
+    bad_masks[:] = 1
+    advantages, returns = estimate_advantages(rewards, masks, bad_masks, values, next_values, 0.99, 0.95,
+                                              torch.device('cpu'))
+    changed = rewards.clone()
+    changed[5:] += 10.
+    _, changed_returns = estimate_advantages(changed, masks, bad_masks, values, next_values, 0.99, 0.95,
+                                             torch.device('cpu'))
+    assert torch.allclose(returns[:5], changed_returns[:5])
+    assert masks[-1] == 0
+    _, ref_returns = reference_gae(rewards.view(-1, 1), masks.view(-1, 1), bad_masks.view(-1, 1), values,
+                                   next_values, 0.99, 0.95)
+    assert torch.allclose(returns, ref_returns, atol=1e-10)
+
+
+def test_float32_batch():
+    rewards, masks, bad_masks, values, next_values = random_batch([12, 30, 9, 1, 60], 4)
+    advantages, returns = estimate_advantages(rewards.float(), masks, bad_masks, values.float(), next_values.float(),
+                                              0.99, 0.95, torch.device('cpu'))
+    ref_advantages, ref_returns = reference_gae(rewards.view(-1, 1), masks.view(-1, 1), bad_masks.view(-1, 1),
+                                                values, next_values, 0.99, 0.95)
+    assert advantages.dtype == torch.float32
+    assert torch.allclose(advantages.double(), ref_advantages, atol=1e-4)
+    assert torch.allclose(returns.double(), ref_returns, atol=1e-4)
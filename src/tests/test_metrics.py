@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import editdistance
+from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from utils.evaluation import create_od_set, get_metrics
+from utils.metrics import TrajectoryMetrics
+
+smoothie = SmoothingFunction().method1
+
+
+def reference_scores(test_trajs, learner_trajs, metric):
+    """the per-OD loops of the former evaluate_edit_dist / evaluate_bleu_score, in their visiting order"""
+    scores = []
+    for idx_list in create_od_set(test_trajs).values():
+        test_od_trajs = set(['_'.join(test_trajs[i]) for i in idx_list])
+        test_od_trajs = [traj.split('_') for traj in test_od_trajs]
+        for learner in [learner_trajs[i] for i in idx_list]:
+            if metric == 'bleu':
+                scores.append(sentence_bleu(test_od_trajs, learner, smoothing_function=smoothie))
+                continue
+            min_edit_dist = 1.0
+            for test in test_od_trajs:
+                min_edit_dist = min(editdistance.eval(test, learner) / len(test), min_edit_dist)
+            scores.append(min_edit_dist)
+    return scores
+
+
+def random_trajs(n_od, n_traj, seed):
+    """test paths over a few ODs, each with repeated routes, and learner paths ranging from exact hits to junk"""
+    rng = np.random.RandomState(seed)
+    ods = [(str(o), str(d)) for o, d in rng.randint(0, 400, size=(n_od, 2))]
+    test_trajs, learner_trajs = [], []
+    for _ in range(n_traj):
+        o, d = ods[rng.randint(n_od)]
+        middle = [str(s) for s in rng.randint(0, 20, size=rng.randint(0, 8))]
+        test_trajs.append([o] + middle + [d])
+    for i, traj in enumerate(test_trajs):
+        kind = i % 4
+        if kind == 0:
+            learner_trajs.append(list(traj))  # exact hit
+        elif kind == 1:
+            learner_trajs.append(traj[:rng.randint(1, len(traj) + 1)])  # truncated, exercises the brevity penalty
+        elif kind == 2:
+            learner = list(traj)
+            learner[rng.randint(len(learner))] = str(rng.randint(0, 20))
+            learner_trajs.append(learner)
+        else:
+            learner_trajs.append([str(s) for s in rng.randint(500, 520, size=rng.randint(1, 10))])  # no overlap
+    return test_trajs, learner_trajs
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_bleu_matches_nltk(seed):
+    test_trajs, learner_trajs = random_trajs(12, 300, seed)
+    metrics = TrajectoryMetrics(test_trajs)
+    scores = metrics.scores(learner_trajs, 'bleu')[metrics.eval_order]
+    np.testing.assert_allclose(scores, reference_scores(test_trajs, learner_trajs, 'bleu'), rtol=1e-12, atol=1e-15)
+    assert metrics.bleu_score(learner_trajs) == pytest.approx(
+        np.mean(reference_scores(test_trajs, learner_trajs, 'bleu')), rel=1e-12)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_edit_dist_matches_editdistance(seed):
+    test_trajs, learner_trajs = random_trajs(12, 300, seed)
+    metrics = TrajectoryMetrics(test_trajs)
+    scores = metrics.scores(learner_trajs, 'edit')[metrics.eval_order]
+    np.testing.assert_array_equal(scores, reference_scores(test_trajs, learner_trajs, 'edit'))
+    assert metrics.edit_dist(learner_trajs) == pytest.approx(
+        np.mean(reference_scores(test_trajs, learner_trajs, 'edit')), rel=1e-12)
+
+
+def test_get_metrics_is_keyed_on_the_test_list():
+    test_trajs, _ = random_trajs(4, 20, 0)
+    metrics = get_metrics(test_trajs)
+    assert get_metrics(test_trajs) is metrics
+    other_trajs = [list(traj) for traj in test_trajs]
+    assert get_metrics(other_trajs) is not metrics
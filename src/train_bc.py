@@ -1,8 +1,10 @@
 import time
 import torch
 import numpy as np
-from utils.load_data import load_path_feature, load_link_feature, minmax_normalization, load_test_traj
+from utils.load_data import load_path_feature_store, load_link_feature, minmax_normalization, load_test_traj, \
+    load_speed_feature
 from utils.evaluation import evaluate_model, evaluate_log_prob
+from utils.policy_cache import PolicyTableCache
 from network_env import RoadWorld
 from model.policy import PolicyCNN
 
@@ -16,32 +18,23 @@ if __name__ == '__main__':
     max_iter_num = 6
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-    edge_p = "../data/edge.txt"
-    network_p = "../data/transit.npy"
-    path_feature_p = "../data/feature_od.npy"
-    train_p = "../data/cross_validation/train_CV%d_size%d.csv" % (cv, size)
-    test_p = "../data/cross_validation/test_CV%d.csv" % cv
-    # test_p = "../data/cross_validation/train_CV%d_size%d.csv" % (cv, size)
+    edge_p = "../data/base/edge.txt"
+    network_p = "../data/base/transit.npy"
+    path_feature_p = "../data/direction/feature_od_direction.npy"
+    speed_p = "../data/speed/updated_edges.txt"
+    train_p = "../data/base/cross_validation/train_CV%d_size%d.csv" % (cv, size)
+    test_p = "../data/base/cross_validation/test_CV%d.csv" % cv
+    # test_p = "../data/base/cross_validation/train_CV%d_size%d.csv" % (cv, size)
     model_p = "../trained_models/bc_CV%d_size%d.pt" % (cv, size)
     """initialize road environment"""
     env = RoadWorld(network_p, edge_p)
     """load path-level and link-level feature"""
-    path_feature, path_max, path_min = load_path_feature(path_feature_p)
-    print('path_feature',path_feature)
-    print('path_max',path_max)
-    print('path_max',path_min)
+    # normalized float32 table memory-mapped from its cache, the pad state is served as zeros
+    path_feature_pad = load_path_feature_store(path_feature_p, env.n_states)
+    speed_feature = load_speed_feature(speed_p, env.n_states)
 
     edge_feature, edge_max, edge_min = load_link_feature(edge_p)
     print('edge_feature',edge_feature)
-    print('edge_feature',edge_feature)
-    print('edge_feature',edge_feature)
-
-    path_feature = minmax_normalization(path_feature, path_max, path_min)
-    print('path_feature.shape[2]',path_feature.shape[2])
-    path_feature_pad = np.zeros((env.n_states, env.n_states, path_feature.shape[2]))
-    print('path_feature_pad',path_feature_pad)
-    path_feature_pad[:path_feature.shape[0], :path_feature.shape[1], :] = path_feature
-    print('path_feature_pad',path_feature_pad)
 
     edge_feature = minmax_normalization(edge_feature, edge_max, edge_min)
     print('edge_feature norm', edge_feature)
@@ -50,20 +43,23 @@ if __name__ == '__main__':
     print('edge_feature_pad', edge_feature_pad)
     """initiate model"""
     CNNMODEL = PolicyCNN(env.n_actions, env.policy_mask, env.state_action, path_feature_pad, edge_feature_pad,
-                         path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1, env.pad_idx).to(device)
+                         path_feature_pad.shape[-1] + edge_feature_pad.shape[-1] + 1, env.pad_idx,
+                         speed_feature).to(device)
     CNNMODEL.to_device(device)
     criterion = torch.nn.NLLLoss()
     optimizer = torch.optim.Adam(CNNMODEL.parameters(), lr=learning_rate)
     """load train data"""
     train_trajs = env.import_demonstrations_step(train_p)
-    train_state_list, train_des_list, train_action_list = [], [], []
+    train_state_list, train_des_list, train_time_step_list, train_action_list = [], [], [], []
     for episode in train_trajs:
         for x in episode:
             train_state_list.append(x.cur_state)
             train_des_list.append(episode[-1].next_state)
+            train_time_step_list.append(x.time_step)
             train_action_list.append(x.action)
     x_state_train = torch.LongTensor(train_state_list).to(device)
     x_des_train = torch.LongTensor(train_des_list).to(device)
+    x_time_step_train = torch.LongTensor(train_time_step_list).to(device)
     y_train = torch.LongTensor(train_action_list).to(device)
     """train model"""
     start_time = time.time()
@@ -72,8 +68,10 @@ if __name__ == '__main__':
             batch_right = min(i + batch_size, x_state_train.shape[0])
             sampled_x_state_train = x_state_train[i:batch_right]
             sampled_x_des_train = x_des_train[i:batch_right]
+            sampled_x_time_step_train = x_time_step_train[i:batch_right]
             sampled_y_train = y_train[i:batch_right].contiguous().view(-1)
-            y_est = CNNMODEL.get_action_log_prob(sampled_x_state_train, sampled_x_des_train)
+            y_est = CNNMODEL.get_action_log_prob(sampled_x_state_train, sampled_x_des_train,
+                                                 sampled_x_time_step_train)
             loss = criterion(y_est.view(-1, y_est.size(1)), sampled_y_train)
             optimizer.zero_grad()
             loss.backward()
@@ -84,8 +82,11 @@ if __name__ == '__main__':
     print('training time', time.time() - start_time)
     target_traj, target_od = load_test_traj(test_p)
     target_od = torch.from_numpy(target_od).long().to(device)
-    evaluate_model(target_od, target_traj, CNNMODEL, env)
+    # the (des, time_step) tables of route decoding are read again by the log-likelihood scoring
+    cache = PolicyTableCache(CNNMODEL, env.n_states)
+    evaluate_model(target_od, target_traj, CNNMODEL, env, cache=cache)
     print('test time', time.time() - start_time)
     """evaluate log prob"""
     test_trajs = env.import_demonstrations_step(test_p)
-    evaluate_log_prob(test_trajs, CNNMODEL)
+    evaluate_log_prob(test_trajs, CNNMODEL, cache=cache)
+    print('policy table hit rate', cache.hit_rate())
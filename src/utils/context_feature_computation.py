@@ -1,8 +1,15 @@
 import pandas as pd
 import numpy as np
-from yen_ksp import ksp_yen, construct_graph
+try:
+    from yen_ksp import ksp_yen, construct_graph
+    from shortest_path import graph_to_csr, shortest_path_tree, accumulate_along_tree, edge_lookup, find_edges
+except ImportError:  # imported as utils.context_feature_computation from src
+    from utils.yen_ksp import ksp_yen, construct_graph
+    from utils.shortest_path import graph_to_csr, shortest_path_tree, accumulate_along_tree, edge_lookup, find_edges
 import time
 import math
+import os
+import multiprocessing
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
     """
@@ -64,8 +71,9 @@ def calculate_bearing_between_edges(u1, v1, u2, v2, node_df):
 #     return edge2attr, len(level2idx.keys())
 
 def create_edge_dict(edge_path, hide_link=None):
-    # Read the edge file including the 'Ratio' column
-    edge_df = pd.read_csv(edge_path, usecols=['highway', 'length', 'n_id', 'u', 'v', 'Ratio'], dtype={'highway': str})
+    # Read the edge file including the ratio column (named 'Ratio' or 'ratio' depending on the export)
+    edge_df = pd.read_csv(edge_path, usecols=lambda c: c in ['highway', 'length', 'n_id', 'u', 'v', 'Ratio', 'ratio'],
+                          dtype={'highway': str}).rename(columns={'ratio': 'Ratio'})
     
     # Process the 'highway' column
     edge_df['highway'] = edge_df['highway'].apply(lambda loc: (loc.split(',')[0])[2:-1] if ',' in loc else loc)
@@ -174,25 +182,194 @@ def create_path_features(path, edge2attr, transit_dict, graph, num_level, node_d
 #     print(od_features.shape)
 #     np.save(feature_path, od_features)
 
-def create_path_level_features(edge2attr, transit_dict, graph, num_level, feature_path, node_df, hide_link=None):
+def calculate_bearing_array(lat1, lon1, lat2, lon2):
+    """vectorized calculate_bearing"""
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    d_lon = lon2 - lon1
+    x = np.sin(d_lon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) * np.cos(d_lon))
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def create_link_arrays(edge2attr, transit_dict, graph, num_level, node_df, n_link):
+    """per-link arrays used by the shortest-path-tree feature engine"""
+    node_lat = dict(zip(node_df['osmid'].tolist(), node_df['y'].tolist()))
+    node_lon = dict(zip(node_df['osmid'].tolist(), node_df['x'].tolist()))
+    length = np.zeros(n_link)
+    level = np.zeros(n_link, dtype=np.int64)
+    mid_lat, mid_lon = np.full(n_link, np.nan), np.full(n_link, np.nan)
+    for n_id, attr in edge2attr.items():
+        if n_id >= n_link:
+            continue
+        length[n_id] = attr['length']
+        level[n_id] = attr['highway']
+        if attr['u'] in node_lat and attr['v'] in node_lat:
+            mid_lat[n_id] = (node_lat[attr['u']] + node_lat[attr['v']]) / 2
+            mid_lon[n_id] = (node_lon[attr['u']] + node_lon[attr['v']]) / 2
+    turn_src, turn_dst, turn_label = [], [], []
+    for from_id, to_dict in transit_dict.items():
+        for to_id, con in to_dict.items():
+            turn_src.append(from_id)
+            turn_dst.append(to_id)
+            turn_label.append(con)
+    turn_label = np.asarray(turn_label, dtype=np.int64)
+    in_graph = np.zeros(n_link, dtype=bool)
+    in_graph[[v for v in graph if v < n_link]] = True
+    csr = graph_to_csr(graph, max([n_link] + [v + 1 for v in graph]))
+    return {'length': length, 'level': level, 'mid_lat': mid_lat, 'mid_lon': mid_lon, 'in_graph': in_graph,
+            'csr': csr, 'csr_reverse': csr.T.tocsr(),
+            'turn_lookup': edge_lookup(turn_src, turn_dst, n_link), 'turn_label': turn_label}
+
+
+def create_origin_path_features(ori, link_arrays, num_level, n_link):
+    """
+    row [n_link, num_level + 7] of the od feature matrix: the features of the shortest path from ori to every link,
+    read off one shortest-path tree instead of one ksp_yen call per destination
+    """
+    in_graph = link_arrays['in_graph']
+    od_features = np.zeros((n_link, num_level + 7))
+    # ksp_yen yields an empty path for unreachable links inside the graph and for ori itself,
+    # which create_path_features turns into all-zero features with the trailing 1
+    od_features[in_graph, -1] = 1
+    od_features[ori, -1] = 1
+
+    dist, pred = shortest_path_tree(link_arrays['csr'], ori)
+    dist, pred = dist[:n_link], pred[:n_link]
+    pred[pred >= n_link] = -1
+    reached = np.flatnonzero((pred >= 0) & in_graph)
+    if len(reached) == 0:
+        return od_features
+
+    """every tree edge pred[v] -> v adds one road, the length of v, its turn and the road level of v"""
+    turn = np.zeros(n_link, dtype=np.int64)
+    edge = find_edges(link_arrays['turn_lookup'], pred[reached], reached, n_link)
+    turn[reached] = np.where(edge >= 0, link_arrays['turn_label'][np.maximum(edge, 0)], 0)
+    contrib = np.zeros((n_link, num_level + 5))
+    contrib[:, 0] = 1
+    contrib[:, 1] = link_arrays['length']
+    contrib[:, 2] = turn == 6
+    contrib[:, 3] = turn == 2
+    contrib[:, 4] = turn == 4
+    contrib[np.arange(n_link), 5 + link_arrays['level']] = 1
+    acc = accumulate_along_tree(pred, contrib)[reached]
+
+    od_features[reached, 0] = 1 + acc[:, 0]
+    od_features[reached, 1] = link_arrays['length'][ori] + acc[:, 1]
+    od_features[reached, 2:5] = acc[:, 2:5]
+    od_features[reached, 5:5 + num_level] = acc[:, 5:]
+    od_features[reached, 5 + num_level] = calculate_bearing_array(
+        link_arrays['mid_lat'][ori], link_arrays['mid_lon'][ori],
+        link_arrays['mid_lat'][reached], link_arrays['mid_lon'][reached])
+    return od_features
+
+
+def create_destination_path_features(des, link_arrays, num_level, n_link):
+    """
+    column [n_link, num_level + 7] of the od feature matrix: the features of the shortest path from every link to des,
+    read off one shortest-path tree of the reversed graph rooted at des
+    """
+    in_graph = link_arrays['in_graph']
+    od_features = np.zeros((n_link, num_level + 7))
+    # same empty-path entries as create_origin_path_features
+    if in_graph[des]:
+        od_features[:, -1] = 1
+    od_features[des, -1] = 1
+
+    # succ[v] is the next link on the shortest path from v to des
+    dist, succ = shortest_path_tree(link_arrays['csr_reverse'], des)
+    dist, succ = dist[:n_link], succ[:n_link]
+    succ[succ >= n_link] = -1
+    reached = np.flatnonzero(succ >= 0)
+    if len(reached) == 0 or not in_graph[des]:
+        return od_features
+
+    """every tree edge v -> succ[v] adds one road, the length of succ[v], its turn and the road level of succ[v]"""
+    turn = np.zeros(n_link, dtype=np.int64)
+    edge = find_edges(link_arrays['turn_lookup'], reached, succ[reached], n_link)
+    turn[reached] = np.where(edge >= 0, link_arrays['turn_label'][np.maximum(edge, 0)], 0)
+    nxt = np.maximum(succ, 0)
+    contrib = np.zeros((n_link, num_level + 5))
+    contrib[:, 0] = 1
+    contrib[:, 1] = link_arrays['length'][nxt]
+    contrib[:, 2] = turn == 6
+    contrib[:, 3] = turn == 2
+    contrib[:, 4] = turn == 4
+    contrib[np.arange(n_link), 5 + link_arrays['level'][nxt]] = 1
+    acc = accumulate_along_tree(succ, contrib)[reached]
+
+    od_features[reached, 0] = 1 + acc[:, 0]
+    od_features[reached, 1] = link_arrays['length'][reached] + acc[:, 1]
+    od_features[reached, 2:5] = acc[:, 2:5]
+    od_features[reached, 5:5 + num_level] = acc[:, 5:]
+    od_features[reached, 5 + num_level] = calculate_bearing_array(
+        link_arrays['mid_lat'][reached], link_arrays['mid_lon'][reached],
+        link_arrays['mid_lat'][des], link_arrays['mid_lon'][des])
+    return od_features
+
+
+_worker_state = {}
+
+
+def _init_feature_worker(link_arrays, num_level, n_link, feature_path):
+    _worker_state['args'] = (link_arrays, num_level, n_link)
+    _worker_state['od_features'] = np.lib.format.open_memmap(feature_path, mode='r+')
+
+
+def _build_origin_chunk(origins):
+    """compute and write the rows of a chunk of origins, they are on disk once this returns"""
+    od_features = _worker_state['od_features']
+    for ori in origins:
+        od_features[ori] = create_origin_path_features(ori, *_worker_state['args'])
+    od_features.flush()
+    return origins
+
+
+def create_path_level_features(edge2attr, transit_dict, graph, num_level, feature_path, node_df, hide_link=None,
+                               num_workers=1, chunk_size=16, resume=True):
     """output feature matrix [n_link, n_link, n_features]"""
     """[i, j, k] element of the output matrix is the k-th feature from the-ith link to the j-th destination link"""
+    """one shortest-path tree per origin gives the first ksp_yen path to every destination at once"""
+    """
+    origin rows are sharded over num_workers processes in chunks of chunk_size and written straight into a
+    memory-mapped .npy; finished rows are recorded in <feature_path>.progress.npy, so with resume=True an
+    interrupted build continues where it stopped; the progress file is removed when the build completes
+    """
     edge_len = len(edge2attr.keys())
-    od_features = np.zeros((edge_len, edge_len, num_level + 7))  # 1 more for the angle feature
-    for ori in range(edge_len):
-        print(ori)
-        for des in range(edge_len):
-            if ori == des:
-                path_features = create_path_features([ori], edge2attr, transit_dict, graph, num_level, node_df) + [1]
-                od_features[ori, ori, :] = path_features
-            candidate_path = ksp_yen(graph, ori, des, 1)
-            if len(candidate_path) == 0:
-                continue
-            path_features = create_path_features(candidate_path[0]['path'], edge2attr, transit_dict, graph,
-                                                 num_level, node_df) + [1]
-            od_features[ori, des, :] = path_features
-    print(od_features.shape)
-    np.save(feature_path, od_features)
+    shape = (edge_len, edge_len, num_level + 7)  # 1 more for the angle feature
+    progress_path = feature_path + '.progress.npy'
+    link_arrays = create_link_arrays(edge2attr, transit_dict, graph, num_level, node_df, edge_len)
+
+    done = None
+    if resume and os.path.exists(progress_path) and os.path.exists(feature_path):
+        done = np.lib.format.open_memmap(progress_path, mode='r+')
+        od_features = np.lib.format.open_memmap(feature_path, mode='r')
+        if done.shape != (edge_len,) or od_features.shape != shape:
+            done = None
+        del od_features
+    if done is None:
+        od_features = np.lib.format.open_memmap(feature_path, mode='w+', dtype=np.float64, shape=shape)
+        del od_features
+        done = np.lib.format.open_memmap(progress_path, mode='w+', dtype=bool, shape=(edge_len,))
+    todo = np.flatnonzero(~done)
+    print('origins done %d, to build %d' % (edge_len - len(todo), len(todo)))
+
+    chunks = [todo[i:i + chunk_size].tolist() for i in range(0, len(todo), chunk_size)]
+    init_args = (link_arrays, num_level, edge_len, feature_path)
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers, initializer=_init_feature_worker, initargs=init_args) as pool:
+            for origins in pool.imap_unordered(_build_origin_chunk, chunks):
+                done[origins] = True
+                done.flush()
+                print('origins done %d / %d' % (int(done.sum()), edge_len))
+    else:
+        _init_feature_worker(*init_args)
+        for origins in chunks:
+            done[_build_origin_chunk(origins)] = True
+            done.flush()
+        _worker_state.clear()
+    del done
+    os.remove(progress_path)
+    print(shape)
 
 
 if __name__ == '__main__':
@@ -210,5 +387,5 @@ if __name__ == '__main__':
     print('done load transit...')
     graph = construct_graph(edge_p, network_p)
     print('done construct graph...')
-    create_path_level_features(edge2attr, transit_dict, graph, level_num, feature_p, df)
+    create_path_level_features(edge2attr, transit_dict, graph, level_num, feature_p, df, num_workers=os.cpu_count())
     print("feature od time", time.time()-start_time)
\ No newline at end of file
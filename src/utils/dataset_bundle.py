@@ -0,0 +1,132 @@
+"""
+Compiled dataset bundle: the inputs every entry script derives from the raw files (normalized link features,
+transition CSR, speed table, OD distribution), written once as .npy files plus a meta.json and memory-mapped on load.
+The normalized path features do not depend on the training data: meta.json only records the shared table of
+load_path_feature_store and its min/max, so all bundles map the same file.
+Compile explicitly from src with: python -m utils.dataset_bundle <bundle_dir> --train <train csv>
+"""
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from network_env import RoadWorld
+from utils.feature_store import PathFeatureStore
+from utils.load_data import ini_od_dist, load_link_feature, minmax_normalization, load_speed_feature, \
+    normalized_path_feature_cache, path_feature_range
+
+BUNDLE_VERSION = 2
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _bundle_sources(edge_path, network_path, speed_path, train_path, path_feature_path):
+    sources = {'edge': edge_path, 'network': network_path, 'speed': speed_path, 'train': train_path}
+    if path_feature_path is not None:
+        sources['path_feature'] = path_feature_path
+    return {name: _source_stamp(path) for name, path in sources.items()}
+
+
+def compile_dataset_bundle(bundle_dir, edge_path, network_path, speed_path, train_path, path_feature_path=None):
+    """write the bundle of the raw files into bundle_dir; meta.json is written last and marks it complete"""
+    os.makedirs(bundle_dir, exist_ok=True)
+    meta_path = os.path.join(bundle_dir, 'meta.json')
+    for stale in (meta_path, os.path.join(bundle_dir, 'path_feature.npy')):  # the latter from version 1 bundles
+        if os.path.exists(stale):
+            os.remove(stale)
+    env = RoadWorld(network_path, edge_path)
+    edge_feature, link_max, link_min = load_link_feature(edge_path)
+    edge_feature_pad = np.zeros((env.n_states, edge_feature.shape[1]))
+    edge_feature_pad[:edge_feature.shape[0], :] = minmax_normalization(edge_feature, link_max, link_min)
+    od_list, od_dist = ini_od_dist(train_path)
+    arrays = {'edge_feature': edge_feature_pad, 'link_max': link_max, 'link_min': link_min,
+              'indptr': env.indptr, 'indices': env.indices, 'action_ids': env.action_ids,
+              'speed_feature': load_speed_feature(speed_path, env.n_states),
+              'od_list': np.array(od_list, dtype=str), 'od_dist': np.array(od_dist, dtype=np.float64)}
+    path_feature = None
+    if path_feature_path is not None:
+        path_feature_max, path_feature_min = path_feature_range(path_feature_path)
+        path_feature = {'path': os.path.abspath(normalized_path_feature_cache(path_feature_path)),
+                        'max': path_feature_max.tolist(), 'min': path_feature_min.tolist()}
+    for name, array in arrays.items():
+        np.save(os.path.join(bundle_dir, name + '.npy'), array)
+    meta = {'version': BUNDLE_VERSION, 'n_states': env.n_states, 'n_actions': env.n_actions, 'pad_idx': env.pad_idx,
+            'path_feature': path_feature,
+            'sources': _bundle_sources(edge_path, network_path, speed_path, train_path, path_feature_path)}
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+class DatasetBundle(object):
+    """
+    The arrays of a compiled bundle, memory-mapped copy-on-write (pages are shared between processes and the
+    arrays can still be handed to torch.from_numpy); path_feature maps the shared normalized table.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        with open(os.path.join(bundle_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != BUNDLE_VERSION:
+            raise ValueError('dataset bundle %s has version %s, expected %d'
+                             % (bundle_dir, self.meta['version'], BUNDLE_VERSION))
+        self.n_states = self.meta['n_states']
+        self.edge_feature = self._load('edge_feature')
+        self.link_max, self.link_min = self._load('link_max'), self._load('link_min')
+        self.indptr, self.indices, self.action_ids = self._load('indptr'), self._load('indices'), self._load('action_ids')
+        self.speed_feature = self._load('speed_feature')
+        self.od_list = self._load('od_list').tolist()
+        self.od_dist = self._load('od_dist').tolist()
+        self.path_feature = None
+        self.path_feature_max, self.path_feature_min = None, None
+        path_feature = self.meta['path_feature']
+        if path_feature is not None:
+            path = path_feature['path']
+            self.path_feature = PathFeatureStore(torch.from_numpy(np.load(path, mmap_mode='c')), self.n_states, path)
+            self.path_feature_max, self.path_feature_min = np.array(path_feature['max']), np.array(path_feature['min'])
+
+    def _load(self, name):
+        return np.load(os.path.join(self.bundle_dir, name + '.npy'), mmap_mode='c')
+
+    def road_world(self, network_path, edge_path, **kwargs):
+        """RoadWorld on the bundled transitions, reset over the bundled OD distribution"""
+        return RoadWorld(network_path, edge_path, pre_reset=(self.od_list, self.od_dist),
+                         transitions=(self.indptr, self.indices, self.action_ids), **kwargs)
+
+
+def is_bundle_current(bundle_dir, edge_path, network_path, speed_path, train_path, path_feature_path=None):
+    meta_path = os.path.join(bundle_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['version'] != BUNDLE_VERSION or \
+            meta['sources'] != _bundle_sources(edge_path, network_path, speed_path, train_path, path_feature_path):
+        return False
+    # the shared path feature table lives outside the bundle and is rewritten when its source changes
+    path_feature = meta['path_feature']
+    return path_feature is None or (os.path.exists(path_feature['path']) and
+                                    os.path.getmtime(path_feature['path']) >= os.path.getmtime(path_feature_path))
+
+
+def load_dataset_bundle(bundle_dir, edge_path, network_path, speed_path, train_path, path_feature_path=None):
+    """the bundle in bundle_dir, compiled first when it is missing, of another version or its sources changed"""
+    if not is_bundle_current(bundle_dir, edge_path, network_path, speed_path, train_path, path_feature_path):
+        compile_dataset_bundle(bundle_dir, edge_path, network_path, speed_path, train_path, path_feature_path)
+    return DatasetBundle(bundle_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compile a dataset bundle')
+    parser.add_argument('bundle_dir')
+    parser.add_argument('--train', required=True, help='training csv giving the OD distribution')
+    parser.add_argument('--edge', default='../data/base/edge.txt')
+    parser.add_argument('--network', default='../data/base/transit.npy')
+    parser.add_argument('--speed', default='../data/speed/updated_edges.txt')
+    parser.add_argument('--path-feature', default=None, help='dense OD path feature .npy')
+    args = parser.parse_args()
+    compile_dataset_bundle(args.bundle_dir, args.edge, args.network, args.speed, args.train, args.path_feature)
@@ -1,14 +1,23 @@
-import editdistance
-from nltk.translate.bleu_score import sentence_bleu
 from scipy.spatial import distance
-from nltk.translate.bleu_score import SmoothingFunction
 import numpy as np
 import torch
 import pandas as pd
 import csv
+from utils.policy_cache import PolicyTableCache
+from utils.metrics import TrajectoryMetrics
 
-smoothie = SmoothingFunction().method1
 device = torch.device("cpu")
+_metrics = [None, None]  # last test set and its TrajectoryMetrics, reused while the same list is passed in
+
+
+def get_metrics(test_trajs):
+    """
+    TrajectoryMetrics of test_trajs, rebuilt only when a different list is passed in.
+    Test sets are loaded once and not changed in place, so the list itself is the key; holding it keeps its id valid.
+    """
+    if _metrics[0] is not test_trajs:
+        _metrics[0], _metrics[1] = test_trajs, TrajectoryMetrics(test_trajs)
+    return _metrics[1]
 
 
 def create_od_set(test_trajs):
@@ -32,37 +41,15 @@ def create_od_set(test_trajs):
 #     return test_od_dict
 
 
-def evaluate_edit_dist(test_trajs, learner_trajs, test_od_dict):
-    edit_dist_list = []
-    for od in test_od_dict.keys():
-        idx_list = test_od_dict[od]
-        test_od_trajs = set(['_'.join(test_trajs[i]) for i in idx_list])
-        test_od_trajs = [traj.split('_') for traj in test_od_trajs]
-        learner_od_trajs = [learner_trajs[i] for i in idx_list]
-        for learner in learner_od_trajs:
-            min_edit_dist = 1.0
-            for test in test_od_trajs:
-                edit_dist = editdistance.eval(test, learner) / len(test)
-                min_edit_dist = edit_dist if edit_dist < min_edit_dist else min_edit_dist
-            edit_dist_list.append(min_edit_dist)
-    return np.mean(edit_dist_list)
-
-
-def evaluate_bleu_score(test_trajs, learner_trajs, test_od_dict):
-    bleu_score_list = []
-    for od in test_od_dict.keys():
-        idx_list = test_od_dict[od]
-        # get unique reference
-        test_od_trajs = set(['_'.join(test_trajs[i]) for i in idx_list])
-        test_od_trajs = [traj.split('_') for traj in test_od_trajs]
-        learner_od_trajs = [learner_trajs[i] for i in idx_list]
-        for learner in learner_od_trajs:
-            # print(test_od_trajs)
-            # print(learner)
-            bleu_score = sentence_bleu(test_od_trajs, learner, smoothing_function=smoothie)
-            bleu_score_list.append(bleu_score)
-
-        # Save test and learner trajectories side by side in a CSV file
+def evaluate_edit_dist(test_trajs, learner_trajs):
+    # the od grouping is cached with the test set, see TrajectoryMetrics
+    return get_metrics(test_trajs).edit_dist(learner_trajs)
+
+
+def evaluate_bleu_score(test_trajs, learner_trajs):
+    bleu_score = get_metrics(test_trajs).bleu_score(learner_trajs)
+
+    # Save test and learner trajectories side by side in a CSV file
     with open('trajectories.csv', 'w', newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(['Test Trajectory', 'Learner Trajectory'])
@@ -72,7 +59,7 @@ def evaluate_bleu_score(test_trajs, learner_trajs, test_od_dict):
             learner_traj_str = '_'.join(learner_traj)
             csv_writer.writerow([test_traj_str, learner_traj_str])
 
-    return np.mean(bleu_score_list)
+    return bleu_score
 
 # def evaluate_edit_dist(test_trajs, learner_trajs, test_od_dict):
 #     edit_dist_list = []
@@ -120,21 +107,35 @@ def evaluate_dataset_dist(test_trajs, learner_trajs):
     return distance.jensenshannon(test_p, learner_p)
 
 
-def evaluate_log_prob(test_traj, model):
-    log_prob_list = []
-    for episode in test_traj:
-        des = torch.LongTensor([episode[-1].next_state]).long().to(device)
-        log_prob = 0
-        for x in episode:
-            with torch.no_grad():
-                next_prob = torch.log(model.get_action_prob(torch.LongTensor([x.cur_state]).to(device), des)).squeeze()
-            next_prob_np = next_prob.detach().cpu().numpy()
-
-            #change
-            log_prob += next_prob_np[int(x.action)]
-        log_prob_list.append(log_prob)
-    print(np.mean(log_prob_list))
-    return np.mean(log_prob_list)
+def evaluate_log_prob(test_traj, model, chunk_size=8192, return_steps=False, cache=None):
+    """
+    mean episode log-likelihood of the test trajectories under the policy; all steps are flattened into
+    (state, des, time_step, action) tensors and scored chunk_size at a time, or read off the tables of a
+    PolicyTableCache, then summed per episode; return_steps also returns the per-step log-probs
+    """
+    model_device = next(model.parameters()).device
+    episode_len = np.array([len(episode) for episode in test_traj], dtype=np.int64)
+    steps = [(x.cur_state, episode[-1].next_state, x.time_step, x.action) for episode in test_traj for x in episode]
+    steps = torch.tensor(steps, dtype=torch.long).reshape(-1, 4).to(model_device)
+    state, des, time_step, action = steps.unbind(1)
+
+    step_log_prob = torch.empty(steps.size(0), device=model_device)
+    for start in range(0, steps.size(0), chunk_size):
+        end = start + chunk_size
+        with torch.no_grad():
+            if cache is None:
+                action_prob = model.get_action_prob(state[start:end], des[start:end], time_step[start:end])
+            else:
+                action_prob = cache.action_prob(state[start:end], des[start:end], time_step[start:end])
+        step_log_prob[start:end] = torch.log(action_prob.gather(1, action[start:end].unsqueeze(1))).squeeze(1)
+
+    episode_idx = torch.from_numpy(np.repeat(np.arange(len(episode_len)), episode_len)).to(model_device)
+    log_prob = torch.zeros(len(episode_len), device=model_device).index_add_(0, episode_idx, step_log_prob)
+    mean_log_prob = log_prob.mean().item()
+    print(mean_log_prob)
+    if return_steps:
+        return mean_log_prob, step_log_prob.cpu().numpy()
+    return mean_log_prob
 
 
 # def evaluate_log_prob(test_traj, model):
@@ -155,15 +156,13 @@ def evaluate_log_prob(test_traj, model):
 
 def evaluate_train_edit_dist(train_traj, learner_traj):
     """This function is used to keep the training epoch with the best edit distance performance on the training data"""
-    test_od_dict = create_od_set(train_traj)
-    edit_dist = evaluate_edit_dist(train_traj, learner_traj, test_od_dict)
+    edit_dist = evaluate_edit_dist(train_traj, learner_traj)
     return edit_dist
 
 
 def evaluate_metrics(test_traj, learner_traj):
-    test_od_dict = create_od_set(test_traj)
-    edit_dist = evaluate_edit_dist(test_traj, learner_traj, test_od_dict)
-    bleu_score = evaluate_bleu_score(test_traj, learner_traj, test_od_dict)
+    edit_dist = evaluate_edit_dist(test_traj, learner_traj)
+    bleu_score = evaluate_bleu_score(test_traj, learner_traj)
     js_dist = evaluate_dataset_dist(test_traj, learner_traj)
     print('edit dist', edit_dist)
     print('bleu score', bleu_score)
@@ -231,85 +230,79 @@ def evaluate_metrics(test_traj, learner_traj):
 #     return learner_traj  # Return the generated trajectories
 
 
-def evaluate_model(target_od, target_traj, model, env, n_link=437):
-    state_ts = torch.from_numpy(np.arange(n_link)).long().to(device)
-    target_o, target_d = target_od[:, 0].tolist(), target_od[:, 1].tolist()
-    target_time_steps = target_od[:, 2].tolist()
-    learner_traj = []
-
-    # Move model parameters to CPU
-    for param in model.parameters():
-        param.data = param.data.to(device)
-
-    """compute transition matrix for the first OD pair"""
-    curr_ori, curr_des, curr_time_step = target_o[0], target_d[0], target_time_steps[0]
-    des_ts = (torch.ones_like(state_ts) * curr_des).to(device)
-    time_step_ts = (torch.ones_like(state_ts) * curr_time_step).to(device)
-    action_prob = model.get_action_prob(state_ts, des_ts, time_step_ts).detach().cpu().numpy()  # 714, 8
-    state_action = env.state_action[:-1]
-    action_prob[state_action == env.pad_idx] = 0.0
-    transit_prob = np.zeros((n_link, n_link))
-    from_st, ac = np.where(state_action != env.pad_idx)
-    to_st = state_action[state_action != env.pad_idx]
-    transit_prob[from_st, to_st] = action_prob[from_st, ac]
-
-    """compute sample path for the first OD pair"""
-    sample_path = [str(curr_ori)]
-    curr_state = curr_ori
-    for _ in range(50):
-        if curr_state == curr_des:
-            break
-        next_state = np.argmax(transit_prob[curr_state])
-        sample_path.append(str(next_state))
-        curr_state = next_state
-    learner_traj.append(sample_path)
-
-    # Initialize trajectory data list to store the results
-    trajectory_data = []
-
-    for i, (ori, des, time_step) in enumerate(zip(target_o[1:], target_d[1:], target_time_steps[1:])):
-        if des == curr_des and ori == curr_ori and time_step == curr_time_step:
-            learner_traj.append(sample_path)
-            learner_path = sample_path
-        else:
-            curr_ori, curr_des, curr_time_step = ori, des, time_step
-            des_ts = (torch.ones_like(state_ts) * curr_des).to(device)
-            time_step_ts = (torch.ones_like(state_ts) * curr_time_step).to(device)
-            action_prob = model.get_action_prob(state_ts, des_ts, time_step_ts).detach().cpu().numpy()  # 714, 8
-            state_action = env.state_action[:-1]
-            action_prob[state_action == env.pad_idx] = 0.0
-            transit_prob = np.zeros((n_link, n_link))
-            from_st, ac = np.where(state_action != env.pad_idx)
-            to_st = state_action[state_action != env.pad_idx]
-            transit_prob[from_st, to_st] = action_prob[from_st, ac]
-
-            sample_path = [str(curr_ori)]
-            curr_state = curr_ori
-            for _ in range(50):
-                if curr_state == curr_des:
-                    break
-                next_state = np.argmax(transit_prob[curr_state])
-                sample_path.append(str(next_state))
-                curr_state = next_state
-            learner_traj.append(sample_path)
-            learner_path = sample_path
-
-        # Save data for this OD pair (including the first one)
-        target_path = target_traj[i]
-        target_path_str = '_'.join(map(str, target_path))
-        learner_path_str = '_'.join(map(str, learner_traj[i]))
-        trajectory_data.append([target_path_str, str(time_step), learner_path_str, str(time_step)])
-
-    # Save trajectory data to CSV
+def greedy_next_state(action_prob, state_action, pad_idx):
+    """
+    [n_link] greedy successor of every link given its [n_link, n_actions] action probabilities:
+    the most probable reachable link, ties going to the smallest link id (argmax over a dense link x link
+    transition matrix); when actions share a target the last one counts, links without a positive choice go to 0
+    """
+    to_state = state_action
+    valid = to_state != pad_idx
+    # an action is shadowed by a later action reaching the same link
+    same = (to_state.unsqueeze(2) == to_state.unsqueeze(1)) & valid.unsqueeze(2) & valid.unsqueeze(1)
+    shadowed = torch.triu(torch.ones(same.size(1), same.size(1), dtype=torch.bool, device=same.device), 1)
+    valid = valid & ~(same & shadowed).any(2)
+    prob = action_prob.masked_fill(~valid, 0)
+    best = prob.max(1, keepdim=True)[0]
+    tie = valid & (prob == best)
+    next_state = to_state.masked_fill(~tie, pad_idx).min(1)[0]
+    return next_state.masked_fill(best.squeeze(1) <= 0, 0)
+
+
+def od_array(target_od):
+    """[n, 3] int64 numpy (ori, des, time_step) rows of target_od, given as a list, an array or a tensor on any device"""
+    if torch.is_tensor(target_od):
+        target_od = target_od.cpu().numpy()
+    return np.asarray(target_od, dtype=np.int64)
+
+
+def decode_greedy_routes(target_od, model, env, n_link=None, max_step=50, cache=None):
+    """
+    greedy route of every (ori, des, time_step) row of target_od; rows are grouped by (des, time_step) and each
+    group reads one policy table (see PolicyTableCache), then advances all its origins together
+    """
+    n_link = env.pad_idx if n_link is None else n_link
+    cache = PolicyTableCache(model, env.n_states) if cache is None else cache
+    model_device = next(model.parameters()).device
+    state_action = torch.from_numpy(env.state_action[:n_link]).long().to(model_device)
+    target_od = od_array(target_od)
+    routes = np.zeros((len(target_od), max_step + 1), dtype=np.int64)
+    route_len = np.zeros(len(target_od), dtype=np.int64)
+
+    groups, group_idx = np.unique(target_od[:, 1:3], axis=0, return_inverse=True)
+    group_idx = group_idx.reshape(-1)
+    order = np.argsort(group_idx, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(group_idx, minlength=len(groups)))])
+    for g, (des, time_step) in enumerate(groups.tolist()):
+        rows = order[bounds[g]:bounds[g + 1]]
+        action_prob = cache.table(des, time_step)[:n_link]
+        next_state = greedy_next_state(action_prob, state_action, env.pad_idx).cpu().numpy()
+        cur = target_od[rows, 0]
+        routes[rows, 0] = cur
+        active = np.ones(len(rows), dtype=bool)
+        length = np.ones(len(rows), dtype=np.int64)
+        for step in range(1, max_step + 1):
+            active &= cur != des
+            if not active.any():
+                break
+            cur = np.where(active, next_state[cur], cur)
+            routes[rows[active], step] = cur[active]
+            length += active
+        route_len[rows] = length
+    return [[str(s) for s in route[:n]] for route, n in zip(routes.tolist(), route_len.tolist())]
+
+
+def evaluate_model(target_od, target_traj, model, env, n_link=None, cache=None):
+    learner_traj = decode_greedy_routes(target_od, model, env, n_link, cache=cache)
+
+    # Save test and learner trajectories with their time steps, one row per test trip
     with open('trajectory_with_timestep.csv', 'w', newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(['Test Trajectory', 'Test Trajectory Timestep', 'Learner Trajectory', 'Learner Trajectory Timestep'])
-        csv_writer.writerows(trajectory_data)
-    
+        for target_path, learner_path, time_step in zip(target_traj, learner_traj, od_array(target_od)[:, 2].tolist()):
+            csv_writer.writerow(['_'.join(map(str, target_path)), str(time_step), '_'.join(learner_path), str(time_step)])
+
     # Evaluate the generated trajectories
     evaluate_metrics(target_traj, learner_traj)
 
     return learner_traj  # Return the generated trajectories
-
-
-
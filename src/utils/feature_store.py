@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def _device_key(device):
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+class PathFeatureStore(object):
+    """
+    OD path features [n_link, n_link, F] shared by the policy, value and discriminator networks.
+    The CPU tensor can be a view of a float32 memory-mapped .npy, so every process reads the same pages.
+    Indices past the stored links (the pad state) read as zero features: the padded copy is never built.
+    """
+
+    def __init__(self, feature, n_states=None, path=None):
+        self.feature = feature
+        self.n_link = feature.size(0)
+        self.n_states = self.n_link if n_states is None else n_states
+        self.shape = (self.n_states, self.n_states, feature.size(2))
+        self.path = path  # the memory-mapped file backing the CPU tensor, if any
+        self._stores = {_device_key(feature.device): self}  # one store per device, shared by all copies
+
+    def to(self, device):
+        key = _device_key(device)
+        if key not in self._stores:
+            store = PathFeatureStore(self.feature.to(key), self.n_states, self.path)
+            store._stores = self._stores
+            self._stores[key] = store
+        return self._stores[key]
+
+    def gather(self, state, des):
+        """features of the (state, des) pairs, state and des broadcast against each other"""
+        state, des = torch.broadcast_tensors(state, des)
+        valid = (state < self.n_link) & (des < self.n_link)
+        feature = self.feature[state.clamp(max=self.n_link - 1), des.clamp(max=self.n_link - 1)]
+        return feature.masked_fill(~valid.unsqueeze(-1), 0)
+
+    def __deepcopy__(self, memo):
+        # read-only data: copies of a model (e.g. the rollout policy) keep sharing it
+        return self
+
+    def __getstate__(self):
+        state = {'n_states': self.n_states, 'path': self.path}
+        if self.path is None or self.feature.device.type != 'cpu':
+            state['feature'] = self.feature
+        return state
+
+    def __setstate__(self, state):
+        if 'feature' in state:
+            feature = state['feature']
+        else:
+            feature = torch.from_numpy(np.load(state['path'], mmap_mode='c'))
+        self.__init__(feature, state['n_states'], state['path'])
+
+
+class PathFeatureProvider(object):
+    """
+    Drop-in replacement for PathFeatureStore on networks where the dense [n_link, n_link, F] table does not fit:
+    destination slices [n_link, F] are computed on request by feature_fn(des) and kept in an LRU of cache_size
+    slots, preallocated on the device the first time a slice is needed.
+    """
+
+    def __init__(self, feature_fn, n_link, n_feature, n_states=None, cache_size=256, device='cpu'):
+        self.feature_fn = feature_fn
+        self.n_link = n_link
+        self.n_states = n_link if n_states is None else n_states
+        self.shape = (self.n_states, self.n_states, n_feature)
+        self.cache_size = min(cache_size, n_link)
+        self.device = _device_key(device)
+        self.buffer = None
+        self.slots = OrderedDict()  # des -> slot in buffer, least recently used first
+        self._providers = {self.device: self}
+
+    def to(self, device):
+        key = _device_key(device)
+        if key not in self._providers:
+            provider = PathFeatureProvider(self.feature_fn, self.n_link, self.shape[2], self.n_states,
+                                           self.cache_size, key)
+            provider._providers = self._providers
+            self._providers[key] = provider
+        return self._providers[key]
+
+    def _load(self, des_list):
+        """slots holding the slices of des_list (at most cache_size destinations), computing the missing ones"""
+        if self.buffer is None:
+            self.buffer = torch.empty((self.cache_size, self.n_link, self.shape[2]), device=self.device)
+        missing = []
+        for des in des_list:
+            if des in self.slots:
+                self.slots.move_to_end(des)
+            else:
+                missing.append(des)
+        for des in missing:
+            if len(self.slots) < self.cache_size:
+                slot = len(self.slots)
+            else:
+                _, slot = self.slots.popitem(last=False)
+            self.buffer[slot] = torch.as_tensor(self.feature_fn(des), dtype=torch.float32).to(self.device)
+            self.slots[des] = slot
+        return torch.tensor([self.slots[des] for des in des_list], dtype=torch.long, device=self.device)
+
+    def gather(self, state, des):
+        """features of the (state, des) pairs, state and des broadcast against each other"""
+        state, des = torch.broadcast_tensors(state, des)
+        valid = (state < self.n_link) & (des < self.n_link)
+        state_flat = state.clamp(max=self.n_link - 1).reshape(-1)
+        des_unique, des_inverse = torch.unique(des.clamp(max=self.n_link - 1).reshape(-1), return_inverse=True)
+        feature = torch.empty((state_flat.size(0), self.shape[2]), device=self.device)
+        for start in range(0, des_unique.size(0), self.cache_size):
+            slots = self._load(des_unique[start:start + self.cache_size].tolist())
+            if des_unique.size(0) <= self.cache_size:
+                feature = self.buffer[slots[des_inverse], state_flat]
+            else:
+                rows = ((des_inverse >= start) & (des_inverse < start + self.cache_size)).nonzero().squeeze(1)
+                feature[rows] = self.buffer[slots[des_inverse[rows] - start], state_flat[rows]]
+        return feature.view(*state.shape, self.shape[2]).masked_fill(~valid.unsqueeze(-1), 0)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def as_path_feature_store(path_feature):
+    """accept a PathFeatureStore, a PathFeatureProvider or a (padded) numpy feature array"""
+    if isinstance(path_feature, (PathFeatureStore, PathFeatureProvider)):
+        return path_feature
+    return PathFeatureStore(torch.from_numpy(np.asarray(path_feature)).float())
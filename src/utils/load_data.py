@@ -1,5 +1,10 @@
+import os
+from functools import partial
 import pandas as pd
 import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from utils.feature_store import PathFeatureStore, PathFeatureProvider
 
 
 def ini_od_dist(train_path):
@@ -23,6 +28,86 @@ def load_path_feature(path_feature_path):
     return path_feature, path_feature_max, path_feature_min
 
 
+def path_feature_range(path_feature_path, chunk_rows=64):
+    """per feature (max, min) of the path feature .npy, scanned chunk by chunk"""
+    path_feature = np.load(path_feature_path, mmap_mode='r')
+    path_feature_max = np.full(path_feature.shape[2], -np.inf)
+    path_feature_min = np.full(path_feature.shape[2], np.inf)
+    for start in range(0, path_feature.shape[0], chunk_rows):
+        chunk = path_feature[start:start + chunk_rows].reshape(-1, path_feature.shape[2])
+        path_feature_max = np.maximum(path_feature_max, chunk.max(0))
+        path_feature_min = np.minimum(path_feature_min, chunk.min(0))
+    return path_feature_max, path_feature_min
+
+
+def write_normalized_path_feature(path_feature_path, out_path, chunk_rows=64):
+    """min-max normalize the path feature .npy into a float32 .npy at out_path, chunk by chunk; returns (max, min)"""
+    path_feature = np.load(path_feature_path, mmap_mode='r')
+    path_feature_max, path_feature_min = path_feature_range(path_feature_path, chunk_rows)
+    tmp_path = out_path + '.tmp.npy'
+    out = open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=path_feature.shape)
+    for start in range(0, path_feature.shape[0], chunk_rows):
+        out[start:start + chunk_rows] = minmax_normalization(path_feature[start:start + chunk_rows],
+                                                             path_feature_max, path_feature_min)
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    return path_feature_max, path_feature_min
+
+
+def normalized_path_feature_cache(path_feature_path, chunk_rows=64):
+    """path of the normalized float32 table cached next to the source .npy, written when missing or out of date"""
+    cache_path = os.path.splitext(path_feature_path)[0] + '_norm_f32.npy'
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path_feature_path):
+        write_normalized_path_feature(path_feature_path, cache_path, chunk_rows)
+    return cache_path
+
+
+def load_path_feature_store(path_feature_path, n_states, chunk_rows=64):
+    """min-max normalized float32 path features behind a PathFeatureStore, with the pad state served as zeros"""
+    """the normalized table is cached next to the source .npy and memory-mapped, so processes share its pages"""
+    cache_path = normalized_path_feature_cache(path_feature_path, chunk_rows)
+    # copy-on-write keeps the file untouched while giving torch a writable buffer
+    path_feature = np.load(cache_path, mmap_mode='c')
+    print('path_feature', path_feature.shape)
+    return PathFeatureStore(torch.from_numpy(path_feature), n_states, cache_path)
+
+
+def _destination_path_feature(des, link_arrays, num_level, n_link, path_feature_max, path_feature_min):
+    from utils.context_feature_computation import create_destination_path_features
+    path_feature = create_destination_path_features(des, link_arrays, num_level, n_link)
+    return minmax_normalization(path_feature, path_feature_max, path_feature_min)
+
+
+def load_path_feature_provider(edge_path, network_path, node_path, n_states, path_feature_max=None,
+                               path_feature_min=None, cache_size=256, n_range_sample=None, seed=0):
+    """path features computed per destination from the road graph, for networks too large for the dense table"""
+    """
+    without the normalization range (e.g. from load_path_feature) it is scanned over all destinations one slice at
+    a time, or estimated on n_range_sample random destinations (rare road levels may then be missed)
+    """
+    from utils.context_feature_computation import create_edge_dict, load_transit, create_link_arrays, \
+        create_destination_path_features
+    from utils.yen_ksp import construct_graph
+    edge2attr, num_level = create_edge_dict(edge_path)
+    n_link = len(edge2attr)
+    node_df = pd.read_csv(node_path, sep=r'\s+')
+    link_arrays = create_link_arrays(edge2attr, load_transit(network_path), construct_graph(edge_path, network_path),
+                                     num_level, node_df, n_link)
+    if path_feature_max is None or path_feature_min is None:
+        sample = np.arange(n_link) if n_range_sample is None else \
+            np.random.default_rng(seed).choice(n_link, min(n_range_sample, n_link), replace=False)
+        path_feature_max, path_feature_min = np.full(num_level + 7, -np.inf), np.full(num_level + 7, np.inf)
+        for des in sample:
+            path_feature = create_destination_path_features(des, link_arrays, num_level, n_link)
+            path_feature_max = np.maximum(path_feature_max, path_feature.max(0))
+            path_feature_min = np.minimum(path_feature_min, path_feature.min(0))
+    feature_fn = partial(_destination_path_feature, link_arrays=link_arrays, num_level=num_level, n_link=n_link,
+                         path_feature_max=path_feature_max, path_feature_min=path_feature_min)
+    print('path_feature', (n_link, n_link, num_level + 7))
+    return PathFeatureProvider(feature_fn, n_link, num_level + 7, n_states, cache_size)
+
+
 def load_link_feature(edge_path):
     # Read the edge file including the necessary columns
     edge_df = pd.read_csv(edge_path, usecols=['highway', 'length', 'lanes', 'n_id', 'ratio'], dtype={'highway': str, 'lanes': str})
@@ -72,4 +157,16 @@ def load_test_traj(test_path):
     df = pd.read_csv(test_path)
     df.sort_values(by=["des", "ori"], inplace=True)
     test_traj = [path.split('_') for path in df['path'].tolist()]
-    return test_traj, df[['ori', 'des', 'time_step']].values
\ No newline at end of file
+    return test_traj, df[['ori', 'des', 'time_step']].values
+
+def load_speed_feature(speed_path, n_states):
+    """dense [n_states, n_time_steps + 1] speed table indexed by (link, time_step)"""
+    """the pad row and the extra last column hold the default speed 0 for unknown links/time steps"""
+    speed_df = pd.read_csv(speed_path, usecols=['n_id', 'time_step', 'speed'])
+    speed_df = speed_df.loc[(speed_df['n_id'] >= 0) & (speed_df['n_id'] < n_states) & (speed_df['time_step'] >= 0)]
+    n_time_steps = int(speed_df['time_step'].max()) + 1 if len(speed_df) > 0 else 0
+    speed_feature = np.zeros((n_states, n_time_steps + 1), dtype=np.float32)
+    speed_feature[speed_df['n_id'].values.astype(np.int64), speed_df['time_step'].values.astype(np.int64)] = \
+        speed_df['speed'].values
+    print('speed_feature', speed_feature.shape)
+    return speed_feature
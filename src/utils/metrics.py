@@ -0,0 +1,99 @@
+import math
+from collections import Counter
+import editdistance
+import numpy as np
+
+
+def ngram_counts(tokens, n):
+    return Counter(zip(*[tokens[i:] for i in range(n)]))
+
+
+def reference_ngram_counts(references, max_n=4):
+    """for every n-gram order, the max count of each n-gram over the references"""
+    max_counts = []
+    for n in range(1, max_n + 1):
+        counts = {}
+        for reference in references:
+            for ngram, count in ngram_counts(reference, n).items():
+                if count > counts.get(ngram, 0):
+                    counts[ngram] = count
+        max_counts.append(counts)
+    return max_counts
+
+
+def sentence_bleu_tokens(ref_counts, ref_lens, hypothesis, weights=(0.25, 0.25, 0.25, 0.25), epsilon=0.1):
+    """nltk sentence_bleu with SmoothingFunction().method1, on the precomputed reference_ngram_counts"""
+    hyp_len = len(hypothesis)
+    numerators, denominators = [], []
+    for n, max_counts in enumerate(ref_counts[:len(weights)], 1):
+        counts = ngram_counts(hypothesis, n)
+        numerators.append(sum(min(count, max_counts.get(ngram, 0)) for ngram, count in counts.items()))
+        denominators.append(max(1, hyp_len - n + 1))
+    if numerators[0] == 0:
+        return 0
+    closest_ref_len = min(ref_lens, key=lambda ref_len: (abs(ref_len - hyp_len), ref_len))
+    if hyp_len > closest_ref_len:
+        bp = 1
+    else:
+        bp = math.exp(1 - closest_ref_len / hyp_len)
+    p_n = [(num + epsilon) / den if num == 0 else num / den for num, den in zip(numerators, denominators)]
+    return bp * math.exp(math.fsum(w_i * math.log(p_i) for w_i, p_i in zip(weights, p_n)))
+
+
+def edit_dist_tokens(references, hypothesis):
+    """edit distance to the closest reference, relative to the reference length and capped at 1"""
+    min_edit_dist = 1.0
+    for reference in references:
+        edit_dist = editdistance.eval(reference, hypothesis) / len(reference)
+        min_edit_dist = edit_dist if edit_dist < min_edit_dist else min_edit_dist
+    return min_edit_dist
+
+
+class TrajectoryMetrics(object):
+    """
+    Edit distance and BLEU of learner trajectories against a fixed set of test trajectories.
+    The test paths are turned into integer tokens and grouped by OD once; each distinct (OD, learner path)
+    of a call is scored once.
+    """
+
+    def __init__(self, test_trajs):
+        self.test_trajs = test_trajs
+        self.od_dict = {}
+        for i, traj in enumerate(test_trajs):
+            self.od_dict.setdefault((traj[0], traj[-1]), []).append(i)
+        self.traj_od = np.zeros(len(test_trajs), dtype=np.int64)
+        self.references = []  # distinct test paths of every OD
+        for k, idx_list in enumerate(self.od_dict.values()):
+            self.traj_od[idx_list] = k
+            self.references.append(list(dict.fromkeys(tuple(int(s) for s in test_trajs[i]) for i in idx_list)))
+        # test trajectories in the order the per-OD loops used to visit them
+        self.eval_order = np.array([i for idx_list in self.od_dict.values() for i in idx_list], dtype=np.int64)
+        self._ref_counts = None
+
+    @property
+    def ref_counts(self):
+        if self._ref_counts is None:
+            self._ref_counts = [(reference_ngram_counts(refs), [len(ref) for ref in refs]) for refs in self.references]
+        return self._ref_counts
+
+    def score_paths(self, items, metric):
+        """metric ('edit' or 'bleu') of (od index, learner path tokens) items"""
+        if metric == 'edit':
+            return [edit_dist_tokens(self.references[od], path) for od, path in items]
+        ref_counts = self.ref_counts
+        return [sentence_bleu_tokens(ref_counts[od][0], ref_counts[od][1], path) for od, path in items]
+
+    def scores(self, learner_trajs, metric):
+        """per test trajectory metric of the learner trajectory at the same index"""
+        keys = [(od, tuple(int(s) for s in traj)) for od, traj in zip(self.traj_od.tolist(), learner_trajs)]
+        unique = list(dict.fromkeys(keys))
+        unique_scores = self.score_paths(unique, metric)
+        score_of = dict(zip(unique, unique_scores))
+        return np.array([score_of[key] for key in keys], dtype=np.float64)
+
+    def edit_dist(self, learner_trajs):
+        return np.mean(self.scores(learner_trajs, 'edit')[self.eval_order])
+
+    def bleu_score(self, learner_trajs):
+        return np.mean(self.scores(learner_trajs, 'bleu')[self.eval_order])
+
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import torch
+
+
+class PolicyTableCache(object):
+    """
+    LRU of the [n_states, n_actions] action-probability tables of a policy, one per (des, time_step).
+    A table takes one forward over all states the first time its (des, time_step) is asked for; the least recently
+    used tables are dropped once they hold more than max_bytes.
+    The tables are snapshots of the weights: call clear() after the policy is updated.
+    """
+
+    def __init__(self, policy, n_states, max_bytes=256 * 2 ** 20):
+        self.policy = policy
+        self.n_states = n_states
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
+
+    def table(self, des, time_step):
+        key = (int(des), int(time_step))
+        if key in self.tables:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        self.misses += 1
+        state = torch.arange(self.n_states, device=next(self.policy.parameters()).device)
+        with torch.no_grad():
+            table = self.policy.get_action_prob(state, torch.full_like(state, key[0]), torch.full_like(state, key[1]))
+        self.tables[key] = table
+        self.nbytes += table.element_size() * table.nelement()
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            _, old = self.tables.popitem(last=False)
+            self.nbytes -= old.element_size() * old.nelement()
+        return table
+
+    def action_prob(self, state, des, time_step):
+        """[batch, n_actions] action probabilities of (state, des, time_step) rows, read off the tables"""
+        key, inverse = torch.unique(torch.stack([des, time_step], 1), dim=0, return_inverse=True)
+        order = torch.argsort(inverse)
+        counts = torch.bincount(inverse, minlength=key.size(0)).tolist()
+        action_prob = None
+        for (d, t), rows in zip(key.tolist(), torch.split(order, counts)):
+            table = self.table(d, t)
+            if action_prob is None:
+                action_prob = table.new_empty((state.size(0), table.size(1)))
+            rows = rows.to(table.device)
+            action_prob[rows] = table[state.to(table.device)[rows]]
+        return action_prob
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
@@ -1,29 +1,79 @@
 from collections import namedtuple
-import random
+import torch
 
 # Taken from
 # https://github.com/pytorch/tutorials/blob/master/Reinforcement%20(Q-)Learning%20with%20PyTorch.ipynb
 
 Transition = namedtuple('Transition', ('state', 'destination', 'action', 'next_state', 'reward', 'mask', 'bad_mask', 'time_step'))
 
+column_dtypes = Transition(state=torch.long, destination=torch.long, action=torch.long, next_state=torch.long,
+                           reward=torch.float32, mask=torch.long, bad_mask=torch.long, time_step=torch.long)
+
 
 class Memory(object):
-    def __init__(self):
-        self.memory = []
+    """
+    Columnar transition buffer: one preallocated tensor per Transition field, grown by doubling.
+    push writes through numpy views of the tensors, sample returns tensor views without copying.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        columns = Transition(*[torch.empty(capacity, dtype=dtype) for dtype in column_dtypes])
+        if self.size > 0:
+            for column, old_column in zip(columns, self.columns):
+                column[:self.size] = old_column[:self.size]
+        self.columns = columns
+        self._views = Transition(*[column.numpy() for column in columns])
+
+    def _reserve(self, n):
+        capacity = self.columns.state.size(0)
+        if self.size + n > capacity:
+            self._allocate(max(2 * capacity, self.size + n))
 
     def push(self, *args):
         """Saves a transition."""
-        self.memory.append(Transition(*args))
+        self._reserve(1)
+        for view, value in zip(self._views, args):
+            view[self.size] = value
+        self.size += 1
+
+    def push_batch(self, *columns):
+        """Saves a batch of transitions given column-wise."""
+        n = len(columns[0])
+        self._reserve(n)
+        for view, column in zip(self._views, columns):
+            view[self.size:self.size + n] = column
+        self.size += n
 
     def sample(self, batch_size=None):
         if batch_size is None:
-            return Transition(*zip(*self.memory))
+            return Transition(*[column[:self.size] for column in self.columns])
         else:
-            random_batch = random.sample(self.memory, batch_size)
-            return Transition(*zip(*random_batch))
-
-    def append(self, new_memory):
-        self.memory += new_memory.memory
+            random_batch = torch.randperm(self.size)[:batch_size]
+            return Transition(*[column[random_batch] for column in self.columns])
 
     def __len__(self):
-        return len(self.memory)
\ No newline at end of file
+        return self.size
+
+    def __getstate__(self):
+        # only the filled part travels, torch multiprocessing queues pass it through shared memory
+        return {'size': self.size, 'columns': self.sample()}
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.columns = Transition(*state['columns'])
+        self._views = Transition(*[column.numpy() for column in self.columns])
+
+
+def concat_samples(memories):
+    """
+    the Transition of several memories, e.g. the rollout workers' ones: the filled slices are concatenated once,
+    one torch.cat per column, which is the only copy of the merged batch (a single memory is returned without copy)
+    """
+    samples = [memory.sample() for memory in memories]
+    if len(samples) == 1:
+        return samples[0]
+    return Transition(*[torch.cat(columns) for columns in zip(*samples)])
@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+def graph_to_csr(graph, n_node):
+    """[n_node, n_node] CSR adjacency of a yen_ksp.Graph, the entries are the edge costs (explicit zeros are edges)"""
+    rows, cols, costs = [], [], []
+    for u in graph:
+        for v, cost in graph[u].items():
+            rows.append(u)
+            cols.append(v)
+            costs.append(cost)
+    return csr_matrix((np.asarray(costs, dtype=np.float64), (np.asarray(rows, dtype=np.int64),
+                                                              np.asarray(cols, dtype=np.int64))),
+                      shape=(n_node, n_node))
+
+
+def shortest_path_tree(csr, source):
+    """single-source shortest-path tree, returns distances (inf if unreachable) and predecessors (-1 for none)"""
+    dist, pred = dijkstra(csr, directed=True, indices=source, return_predecessors=True)
+    pred = pred.astype(np.int64)
+    pred[pred < 0] = -1
+    return dist, pred
+
+
+def accumulate_along_tree(pred, contrib):
+    """
+    for every node v, sum contrib over the tree path from the root to v, excluding the root itself;
+    computed by pointer jumping so it takes log2(tree depth) vectorized passes
+    """
+    anc = pred.copy()
+    acc = np.where((anc >= 0)[:, None], contrib, 0)
+    has_anc = anc >= 0
+    while has_anc.any():
+        acc[has_anc] += acc[anc[has_anc]]
+        anc[has_anc] = anc[anc[has_anc]]
+        has_anc = anc >= 0
+    return acc
+
+
+def edge_lookup(src, dst, n_node):
+    """sorted edge keys for looking up per-edge values of (src, dst) pairs with searchsorted"""
+    keys = np.asarray(src, dtype=np.int64) * n_node + np.asarray(dst, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
+
+
+def find_edges(lookup, src, dst, n_node):
+    """positions (in the arrays edge_lookup was built from) of the (src, dst) edges, -1 if absent"""
+    keys, order = lookup
+    query = np.asarray(src, dtype=np.int64) * n_node + np.asarray(dst, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(keys, query, side='right') - 1, len(keys) - 1)
+    found = (pos >= 0) & (keys[np.maximum(pos, 0)] == query)
+    return np.where(found, order[np.maximum(pos, 0)], -1)
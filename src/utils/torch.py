@@ -1,2 +1,21 @@
+import torch
+
+
 def to_device(device, *args):
-    return [x.to(device) for x in args]
\ No newline at end of file
+    return [x.to(device) for x in args]
+
+
+def gather_speed(speed_feature, link, time_step):
+    """look up speed_feature[link, time_step]; time steps outside the table fall back to the default last column"""
+    default_col = speed_feature.size(1) - 1
+    time_step = torch.where((time_step >= 0) & (time_step < default_col), time_step,
+                            torch.full_like(time_step, default_col))
+    return speed_feature[link, time_step]
+
+
+def speed_table(speed_feature):
+    """the dense [n_states, n_time_steps + 1] speed table of load_speed_feature as a float32 tensor"""
+    if speed_feature is None:
+        raise ValueError('speed_feature is required: pass the dense [n_states, n_time_steps + 1] speed table '
+                         'of utils.load_data.load_speed_feature')
+    return torch.as_tensor(speed_feature, dtype=torch.float32)